@@ -0,0 +1,322 @@
+#! /usr/bin/python2.7
+# -*- coding: utf-8 -*-
+"""
+Offline, headless benchmarks of the client pipeline.
+
+Measures, for synthetic worlds of several crowd sizes and optionally
+a capture (see agarCapture):
+
+	parse      world_update packets/s through handleMessage
+	features   us per computeFeatures / computeFeaturesVectorized call
+	inference  nn.create_phenotype and net.sactivate calls/s, for
+	           nn_pure and agarNet.CompiledNetwork
+	render     Visualization frames/s (SDL dummy video driver)
+
+Results can be saved as a baseline and later compared against it:
+
+	python agarBench.py --save baseline.json
+	python agarBench.py --compare baseline.json  # exit 1 on regressions
+"""
+
+import os
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import json
+import random
+import struct
+import sys
+from time import time
+
+import pygame
+
+import agarIAo as A
+import agarNet
+from agarServer import encodeStr16
+
+class Workload:
+	"""
+	Frames to set up a world (setup) and world_update frames to
+	replay on it (updates).
+	"""
+	def __init__(self, name, setup, updates):
+		self.name = name
+		self.setup = setup
+		self.updates = updates
+
+	def client(self, world=None):
+		c = A.agarioClient(world=world)
+		for frame in self.setup:
+			c.handleMessage(frame)
+		return c
+
+def encodeCell(cid, x, y, size, color, is_virus=False, name=''):
+	return struct.pack('<IiihBBBB', cid, int(x), int(y), int(size),
+					   color[0], color[1], color[2],
+					   1 if is_virus else 0) + encodeStr16(name)
+
+def encodeWorldUpdate(cells, eats=(), removed=()):
+	parts = [struct.pack('<BH', 16, len(eats))]
+	for a, b in eats:
+		parts.append(struct.pack('<II', a, b))
+	for cell in cells:
+		parts.append(encodeCell(*cell))
+	parts.append(struct.pack('<I', 0))
+	parts.append(struct.pack('<I', len(removed)))
+	for cid in removed:
+		parts.append(struct.pack('<I', cid))
+	return b''.join(parts)
+
+def syntheticWorkload(n, ticks=50, seed=0):
+	"""
+	n cells around the own cell: mostly food, some players, viruses
+	and ejected mass. Each update moves all players and ejected mass
+	and replaces a few eaten food cells.
+	"""
+	rnd = random.Random(seed)
+	spread = 300 * n ** 0.5  # keeps the density roughly constant
+	cx = cy = 3000
+	def place():
+		return (cx + rnd.uniform(-spread, spread) / 2,
+				cy + rnd.uniform(-spread, spread) / 2)
+	def color():
+		return (rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255))
+	own = [1, cx, cy, 60, (200, 50, 50), False, 'agarIAo']
+	cells = {1: own}
+	moving = [own]
+	food = []
+	for cid in range(2, n + 1):
+		x, y = place()
+		kind = rnd.random()
+		if kind < 0.8:
+			cell = [cid, x, y, 10, color(), False, '']
+			food.append(cid)
+		elif kind < 0.9:
+			cell = [cid, x, y, rnd.randint(30, 200), color(), False, 'bot%i' % cid]
+			moving.append(cell)
+		elif kind < 0.95:
+			cell = [cid, x, y, 100, (51, 255, 51), True, '']
+		else:
+			cell = [cid, x, y, 38, color(), False, '']
+			moving.append(cell)
+		cells[cid] = cell
+	setup = [struct.pack('<Bdddd', 64, 0.0, 0.0, 6000.0, 6000.0),
+			 encodeWorldUpdate([tuple(c) for c in cells.values()]),
+			 struct.pack('<BI', 32, 1)]
+	updates = []
+	next_cid = n + 1
+	for t in range(ticks):
+		for cell in moving:
+			cell[1] += rnd.randint(-8, 8)
+			cell[2] += rnd.randint(-8, 8)
+		eats = []
+		born = []
+		for i in range(min(len(food), max(1, n // 100))):
+			j = rnd.randrange(len(food))
+			eats.append((1, food[j]))
+			x, y = place()
+			born.append((next_cid, x, y, 10, color(), False, ''))
+			food[j] = next_cid
+			next_cid += 1
+		updates.append(encodeWorldUpdate(
+			[tuple(c) for c in moving] + born, eats))
+	return Workload('%i cells' % n, setup, updates)
+
+def captureWorkload(path):
+	"""All inbound frames of a capture, replayed as updates."""
+	from agarCapture import CaptureReader
+	reader = CaptureReader(path)
+	try:
+		frames = [bytes(frame) for timestamp, frame in reader.inbound()]
+	finally:
+		reader.close()
+	return Workload(os.path.basename(path), [], frames)
+
+def measure(fn, min_time):
+	"""Seconds per fn() call, best of three runs of at least min_time."""
+	best = None
+	for run in range(3):
+		n = 0
+		start = time()
+		while True:
+			fn()
+			n += 1
+			elapsed = time() - start
+			if elapsed >= min_time:
+				break
+		best = min(best, elapsed / n) if best is not None else elapsed / n
+	return best
+
+worldKinds = [
+	('World', lambda: A.World()),
+	('ArrayWorld', lambda: A.ArrayWorld()),
+	('SpatialGrid', lambda: A.World(index=A.SpatialGrid())),
+]
+
+def benchParse(workload, results, min_time):
+	for kind, make in worldKinds:
+		c = workload.client(make())
+		updates = workload.updates
+		def run():
+			for frame in updates:
+				c.handleMessage(frame)
+		t = measure(run, min_time)
+		results['parse %s %s' % (workload.name, kind)] = \
+			(len(updates) / t, 'packets/s', True)
+
+def benchFeatures(workload, results, min_time):
+	for kind, make in worldKinds:
+		c = workload.client(make())
+		for frame in workload.updates:
+			c.handleMessage(frame)
+		player = c.player
+		out = A.np.empty(A.inputCount)
+		t = measure(lambda: A.computeFeatures(player), min_time)
+		results['features %s %s computeFeatures' % (workload.name, kind)] = \
+			(t * 1e6, 'us', False)
+		t = measure(lambda: A.computeFeaturesVectorized(player, out), min_time)
+		results['features %s %s computeFeaturesVectorized' % (workload.name, kind)] = \
+			(t * 1e6, 'us', False)
+		# what the agent loop does, on the published snapshot
+		snap = player.snapshot
+		t = measure(lambda: A.computeFeaturesVectorized(snap, out), min_time)
+		results['features %s %s snapshot' % (workload.name, kind)] = \
+			(t * 1e6, 'us', False)
+
+def benchRender(workload, results, min_time):
+	c = workload.client()
+	for frame in workload.updates:
+		c.handleMessage(frame)
+	snap = c.player.snapshot
+	features = A.computeFeatures(snap)
+	v = A.Visualization(snap)
+	def frame():
+		v.drawBackGround()
+		v.drawCells(snap.cells)
+		v.drawFeatures(features, A.featuresColors)
+		v.drawScore()
+		v.commit()
+	t = measure(frame, min_time)
+	results['render %s' % workload.name] = (1.0 / t, 'frames/s', True)
+
+def benchInference(workload, results, min_time):
+	c = workload.client()
+	for frame in workload.updates:
+		c.handleMessage(frame)
+	inputs = A.featuresToInputs(A.computeFeatures(c.player),
+								c.player.total_mass).tolist()
+	local_dir = os.path.dirname(os.path.abspath(__file__))
+	config = A.Config(os.path.join(local_dir, 'agarIAo_config'))
+	pop = A.population.Population(config)
+	def evaluate(genomes):
+		# one generation, only to get the initial genomes
+		phenotypes = measure(lambda: [A.nn.create_phenotype(g) for g in genomes],
+							 min_time)
+		results['inference create_phenotype'] = \
+			(len(genomes) / phenotypes, 'phenotypes/s', True)
+		nets = [A.nn.create_phenotype(g) for g in genomes]
+		t = measure(lambda: [net.sactivate(inputs) for net in nets], min_time)
+		results['inference sactivate'] = (len(nets) / t, 'activations/s', True)
+
+		t = measure(lambda: [agarNet.compilePhenotype(g) for g in genomes],
+					min_time)
+		results['inference compilePhenotype'] = \
+			(len(genomes) / t, 'phenotypes/s', True)
+		compiled = [agarNet.compilePhenotype(g) for g in genomes]
+		checkParity(genomes, compiled, inputs)
+		t = measure(lambda: [net.sactivate(inputs) for net in compiled], min_time)
+		results['inference compiled sactivate'] = \
+			(len(compiled) / t, 'activations/s', True)
+		for g in genomes:
+			g.fitness = 1.0  # neat divides by the average fitness
+	pop.epoch(evaluate, 1)
+
+def checkParity(genomes, compiled, inputs, steps=20):
+	"""
+	Asserts compiled networks give the outputs of fresh nn_pure ones,
+	over a few steps so recurrent state is compared too.
+	"""
+	rnd = random.Random(0)
+	for g, net in zip(genomes, compiled):
+		pure = A.nn.create_phenotype(g)
+		net.reset()
+		for step in range(steps):
+			x = [v * rnd.uniform(0.5, 1.5) for v in inputs]
+			expected = pure.sactivate(x)
+			got = net.sactivate(x)
+			assert all(abs(a - b) <= 1e-9 for a, b in zip(expected, got)), \
+				(step, expected, got)
+
+benchmarks = [
+	('parse', benchParse),
+	('features', benchFeatures),
+	('inference', benchInference),
+	('render', benchRender),
+]
+
+def compare(results, baseline, tolerance):
+	"""Prints the change of every result; returns the regressed names."""
+	regressions = []
+	for name in sorted(results):
+		value, unit, higher = results[name]
+		if name not in baseline:
+			print('%-70s %12.1f %-13s (new)' % (name, value, unit))
+			continue
+		old = baseline[name][0]
+		change = (value - old) / old if old else 0.0
+		worse = -change if higher else change
+		flag = ''
+		if worse > tolerance:
+			flag = ' REGRESSION'
+			regressions.append(name)
+		print('%-70s %12.1f %-13s %+6.1f%%%s' % (name, value, unit,
+												 100 * change, flag))
+	return regressions
+
+if __name__ == "__main__":
+
+	import argparse
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+	parser.add_argument('--sizes', default='50,500,5000',
+						help='comma separated crowd sizes of synthetic worlds')
+	parser.add_argument('--capture', action='append', default=[],
+						help='also run on the frames of this capture file')
+	parser.add_argument('--only', default=','.join(b[0] for b in benchmarks),
+						help='comma separated benchmarks to run')
+	parser.add_argument('--min-time', type=float, default=0.2,
+						help='seconds each measurement runs at least')
+	parser.add_argument('--save', metavar='PATH',
+						help='write the results as a baseline')
+	parser.add_argument('--compare', metavar='PATH',
+						help='compare against a saved baseline')
+	parser.add_argument('--tolerance', type=float, default=0.1,
+						help='relative slowdown reported as a regression')
+	args = parser.parse_args()
+
+	workloads = [syntheticWorkload(int(n)) for n in args.sizes.split(',')]
+	workloads += [captureWorkload(path) for path in args.capture]
+	only = args.only.split(',')
+	pygame.init()
+	results = {}
+	for name, bench in benchmarks:
+		if name not in only:
+			continue
+		if name == 'inference':
+			# crowd size does not matter, any features will do
+			bench(workloads[0], results, args.min_time)
+			continue
+		for workload in workloads:
+			bench(workload, results, args.min_time)
+	pygame.quit()
+
+	baseline = {}
+	if args.compare:
+		with open(args.compare) as f:
+			baseline = json.load(f)
+	regressions = compare(results, baseline, args.tolerance)
+	if args.save:
+		with open(args.save, 'w') as f:
+			json.dump(results, f, indent=1, sort_keys=True)
+	if regressions:
+		print('%i regression(s) over %.0f%%' % (len(regressions),
+												100 * args.tolerance))
+		sys.exit(1)
@@ -0,0 +1,209 @@
+#! /usr/bin/python2.7
+# -*- coding: utf-8 -*-
+"""
+Packet capture and replay, for reproducible offline sessions.
+
+CaptureWriter appends every raw frame an agarioClient receives or
+sends to a capture file; set it as the client's recorder:
+
+	c.recorder = CaptureWriter('session.agcap')
+
+CaptureReader memory-maps a capture and iterates its frames.
+ReplayWebSocket plays the inbound frames back through the subset of
+websocket.WebSocket the client uses, so they go through the usual
+handleMessage / parse_* path, at the original pace or as fast as
+possible (speed=0):
+
+	c = agarioClient(p, ws=ReplayWebSocket('session.agcap', speed=0))
+	c.connect('replay', '')
+
+File format: the magic header, then one record per frame, an
+(direction, opcode, timestamp, length) header followed by the frame.
+"""
+
+import mmap
+import struct
+import threading
+from time import sleep, time
+
+INBOUND = 0  # server -> client
+OUTBOUND = 1  # client -> server
+
+magic = b'AGCAP\x01'
+record = struct.Struct('<BBdI')
+
+class CaptureWriter:
+	"""Appends frames to a capture file, from any thread."""
+	def __init__(self, path):
+		self.file = open(path, 'wb')
+		self.file.write(magic)
+		self.lock = threading.Lock()
+		self.frames = 0
+
+	def write(self, direction, frame, timestamp=None):
+		if timestamp is None:
+			timestamp = time()
+		frame = bytes(frame)
+		opcode = bytearray(frame[:1])[0] if frame else 0
+		with self.lock:
+			if self.file.closed:
+				return
+			self.file.write(record.pack(direction, opcode, timestamp, len(frame)))
+			self.file.write(frame)
+			self.frames += 1
+
+	def inbound(self, frame):
+		self.write(INBOUND, frame)
+
+	def outbound(self, frame):
+		self.write(OUTBOUND, frame)
+
+	def flush(self):
+		with self.lock:
+			self.file.flush()
+
+	def close(self):
+		with self.lock:
+			self.file.close()
+
+class CaptureReader:
+	"""
+	Memory-mapped capture file. Iterating yields
+	(direction, opcode, timestamp, frame) tuples in recorded order.
+	"""
+	def __init__(self, path):
+		self.file = open(path, 'rb')
+		self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		if self.map[:len(magic)] != magic:
+			self.close()
+			raise IOError('%s is not a capture file' % path)
+
+	def __iter__(self):
+		data = self.map
+		end = len(data)
+		offset = len(magic)
+		while offset + record.size <= end:
+			direction, opcode, timestamp, length = record.unpack_from(data, offset)
+			offset += record.size
+			if offset + length > end:
+				break  # truncated by an interrupted recording
+			yield direction, opcode, timestamp, data[offset:offset + length]
+			offset += length
+
+	def inbound(self):
+		"""Only the (timestamp, frame) pairs the client received."""
+		for direction, opcode, timestamp, frame in self:
+			if direction == INBOUND:
+				yield timestamp, frame
+
+	def close(self):
+		self.map.close()
+		self.file.close()
+
+class ReplayWebSocket:
+	"""
+	Transport replaying the inbound frames of a capture. Frames are
+	delivered with their recorded spacing divided by speed; speed=0
+	delivers them as fast as they are read. Sent frames are dropped,
+	recv() raises IOError at the end of the capture.
+	"""
+	def __init__(self, path, speed=1.0):
+		self.path = path
+		self.speed = speed
+		self.connected = False
+		self.sock = None
+		self.timeout = None
+		self.reader = None
+		self.frames = None
+		self.pending = None  # next (timestamp, frame), not yet due
+
+	def settimeout(self, timeout):
+		self.timeout = timeout
+
+	def connect(self, url, **options):
+		self.reader = CaptureReader(self.path)
+		self.frames = self.reader.inbound()
+		self.pending = None
+		self.first = None  # recorded time of the first frame
+		self.start = time()
+		self.connected = True
+
+	def send(self, data):
+		if not self.connected:
+			raise IOError('socket is already closed')
+
+	def next_frame(self, block):
+		if self.pending is None:
+			try:
+				self.pending = next(self.frames)
+			except StopIteration:
+				self.close()
+				return None
+		timestamp, frame = self.pending
+		if self.first is None:
+			self.first = timestamp
+		if self.speed > 0:
+			delay = (timestamp - self.first) / self.speed - (time() - self.start)
+			if delay > 0:
+				if not block:
+					return None
+				sleep(delay)
+		self.pending = None
+		return frame
+
+	def recv(self):
+		frame = self.next_frame(True) if self.connected else None
+		if frame is None:
+			raise IOError('socket is already closed')
+		return frame
+
+	def poll(self):
+		"""Returns the next frame if it is due, else None."""
+		if not self.connected:
+			return None
+		return self.next_frame(False)
+
+	def close(self):
+		if self.connected:
+			self.connected = False
+			self.frames = None
+			self.reader.close()
+
+def replay(client, path, speed=0):
+	"""
+	Feeds the inbound frames of a capture to client.handleMessage on
+	this thread. Returns the number of frames replayed.
+	"""
+	reader = CaptureReader(path)
+	n = 0
+	try:
+		first = None
+		start = time()
+		for timestamp, frame in reader.inbound():
+			if first is None:
+				first = timestamp
+			if speed > 0:
+				sleep(max(0.0, (timestamp - first) / speed - (time() - start)))
+			client.handleMessage(frame)
+			n += 1
+	finally:
+		reader.close()
+	return n
+
+if __name__ == "__main__":
+
+	import argparse
+	parser = argparse.ArgumentParser(
+		description='replay a capture through a headless client')
+	parser.add_argument('capture')
+	parser.add_argument('--speed', type=float, default=0,
+						help='1 = recorded pace, 0 = as fast as possible')
+	args = parser.parse_args()
+
+	from agarIAo import agarioClient, SubscriberMock
+	c = agarioClient(SubscriberMock())
+	start = time()
+	n = replay(c, args.capture, args.speed)
+	elapsed = time() - start
+	print('%d frames in %.3fs, %.0f frames/s, %d cells' % (
+		n, elapsed, n / max(elapsed, 1e-9), len(c.player.world.cells)))
@@ -0,0 +1,224 @@
+#! /usr/bin/python2.7
+# -*- coding: utf-8 -*-
+"""
+Incremental population checkpoints.
+
+neat's own checkpoints pickle the whole population, species and
+statistics history every time. Checkpointer keeps two append-only
+files in a directory instead:
+
+	genomes  every distinct genome once, keyed by the SHA-1 of its
+	         pickle: (digest, length) header + zlib'd pickle
+	states   one record per checkpoint: (generation, length) header
+	         + zlib'd pickle of the population with genomes replaced
+	         by their digests
+
+so a checkpoint only writes the genomes that changed since the last
+one (offspring, new fitness values) plus the small state record.
+Pickling happens on the training thread, compressing and writing on
+a background thread. A checkpoint interrupted by preemption is
+ignored on resume, which reads only the genome headers and the last
+state record.
+
+A checkpoint is meant to hold the population neat reproduced after
+generation generations, not evaluated yet, like neat's own; restoring
+it goes on with evaluating that population:
+
+	checkpoints = Checkpointer('checkpoints')
+	generation = checkpoints.restore(pop)  # 0 for a new run
+	...
+	checkpoints.save(pop, generation)      # before evaluating the next
+	checkpoints.close()
+"""
+
+import hashlib
+import io
+import os
+import random
+import struct
+import threading
+import zlib
+from collections import deque
+
+try:
+	import cPickle as pickle
+except ImportError:
+	import pickle
+
+from neat import chromosome, species
+
+genomeHeader = struct.Struct('<20sI')
+stateHeader = struct.Struct('<iI')
+
+def readRecords(path, header):
+	"""Yields (header values, offset of the data) of complete records."""
+	if not os.path.exists(path):
+		return
+	end = os.path.getsize(path)
+	with open(path, 'rb') as f:
+		offset = 0
+		while offset + header.size <= end:
+			f.seek(offset)
+			values = header.unpack(f.read(header.size))
+			offset += header.size
+			length = values[-1]
+			if offset + length > end:
+				return  # cut off by an interrupted checkpoint
+			yield values, offset
+			offset += length
+
+def idCounters(pop):
+	"""
+	neat's genome id, species id and innovation counters, class
+	attributes that pickling pop leaves out, as (class, name) pairs.
+	"""
+	return [(chromosome.Chromosome, '_Chromosome__next_id'),
+			(species.Species, '_Species__next_id'),
+			(pop.conn_gene_type, '_ConnectionGene__global_innov_number'),
+			(pop.conn_gene_type, '_ConnectionGene__innovations')]
+
+def dropIncomplete(path, header):
+	"""Truncates path after its last complete record."""
+	end = 0
+	for values, offset in readRecords(path, header):
+		end = offset + values[-1]
+	if os.path.exists(path) and os.path.getsize(path) > end:
+		with open(path, 'r+b') as f:
+			f.truncate(end)
+
+class Checkpointer:
+	def __init__(self, path, compress_level=1):
+		self.path = path
+		self.compress_level = compress_level
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		self.genomes_path = os.path.join(path, 'genomes')
+		self.states_path = os.path.join(path, 'states')
+		# appending after a cut off record would hide all later ones
+		dropIncomplete(self.genomes_path, genomeHeader)
+		dropIncomplete(self.states_path, stateHeader)
+		self.stored = set(values[0] for values, offset
+						  in readRecords(self.genomes_path, genomeHeader))
+		self.queue = deque()
+		self.cond = threading.Condition()
+		self.error = None
+		self.writer = threading.Thread(target=self.write_loop)
+		self.writer.daemon = True
+		self.writer.start()
+
+	#====================
+
+	def save(self, pop, generation):
+		"""
+		Snapshots pop (its __dict__, neat's id counters and the random
+		state) for generation, then returns; the files are written later.
+		"""
+		if self.error is not None:
+			raise self.error
+		genome_class = type(pop.population[0]) if pop.population else None
+		blobs = {}
+		def persistent_id(obj):
+			if type(obj) is not genome_class:
+				return None
+			data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+			digest = hashlib.sha1(data).digest()
+			if digest not in self.stored:
+				blobs[digest] = data
+			return digest
+		counters = [getattr(cls, name) for cls, name in idCounters(pop)]
+		state = (pop.__dict__, random.getstate(), counters)
+		data = self.dumps(state, persistent_id)
+		self.stored.update(blobs)
+		with self.cond:
+			self.queue.append((generation, blobs, data))
+			self.cond.notify()
+
+	@staticmethod
+	def dumps(obj, persistent_id):
+		f = io.BytesIO()
+		p = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+		p.persistent_id = persistent_id
+		p.dump(obj)
+		return f.getvalue()
+
+	def write_loop(self):
+		while True:
+			with self.cond:
+				while not self.queue:
+					self.cond.wait()
+				job = self.queue[0]
+			if job is None:
+				return
+			try:
+				self.write(*job)
+			except Exception as e:
+				self.error = e
+			with self.cond:
+				self.queue.popleft()
+				self.cond.notify_all()
+
+	def write(self, generation, blobs, data):
+		level = self.compress_level
+		with open(self.genomes_path, 'ab') as f:
+			for digest, blob in blobs.items():
+				blob = zlib.compress(blob, level)
+				f.write(genomeHeader.pack(digest, len(blob)))
+				f.write(blob)
+			f.flush()
+			os.fsync(f.fileno())
+		data = zlib.compress(data, level)
+		with open(self.states_path, 'ab') as f:
+			f.write(stateHeader.pack(generation, len(data)))
+			f.write(data)
+			f.flush()
+			os.fsync(f.fileno())
+
+	def flush(self):
+		"""Waits until all saved checkpoints are written."""
+		with self.cond:
+			while self.queue:
+				self.cond.wait()
+		if self.error is not None:
+			raise self.error
+
+	def close(self):
+		self.flush()
+		with self.cond:
+			self.queue.append(None)
+			self.cond.notify()
+		self.writer.join()
+
+	#====================
+
+	def restore(self, pop):
+		"""
+		Loads the last complete checkpoint into pop, neat's id counters
+		and the random module. Returns its generation, 0 if there is none.
+		"""
+		last = None
+		for values, offset in readRecords(self.states_path, stateHeader):
+			last = values, offset
+		if last is None:
+			return 0
+		(generation, length), offset = last
+		index = dict((values[0], (offset, values[1])) for values, offset
+					 in readRecords(self.genomes_path, genomeHeader))
+		with open(self.states_path, 'rb') as f:
+			f.seek(offset)
+			data = zlib.decompress(f.read(length))
+		genomes = {}
+		with open(self.genomes_path, 'rb') as f:
+			def persistent_load(digest):
+				if digest not in genomes:
+					offset, length = index[digest]
+					f.seek(offset)
+					genomes[digest] = pickle.loads(zlib.decompress(f.read(length)))
+				return genomes[digest]
+			u = pickle.Unpickler(io.BytesIO(data))
+			u.persistent_load = persistent_load
+			state, random_state, counters = u.load()
+		pop.__dict__.update(state)
+		for (cls, name), value in zip(idCounters(pop), counters):
+			setattr(cls, name, value)
+		random.setstate(random_state)
+		return generation
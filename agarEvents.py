@@ -0,0 +1,143 @@
+#! /usr/bin/python2.7
+# -*- coding: utf-8 -*-
+"""
+Game events of an agarioClient.
+
+EventBus only knows the events below, with their keyword arguments.
+Handlers are registered per event with subscribe(); attach(obj)
+subscribes the on_<event> methods obj's class defines. For every
+event the bus has an on_<event> attribute: None while nobody listens,
+so the client skips building the arguments, else a function calling
+the handlers:
+
+	bus = EventBus(history=1000)
+	bus.subscribe('death', lambda: sys.stdout.write('DEAD\\n'))
+	if bus.on_cell_info is not None:
+		bus.on_cell_info(cid=1, x=0, y=0, ...)
+	bus.emit('death')  # same, for rare events
+
+With history, the last history events are kept as (event, data)
+pairs in a ring buffer, and every event is dispatched.
+
+subscribe() checks the handler takes the event's arguments, so a
+misspelled parameter fails when subscribing rather than on the
+listener thread. With debug, every event is dispatched and its
+arguments are checked against the declaration too.
+"""
+
+import inspect
+from collections import OrderedDict, deque
+
+events = OrderedDict([
+	('world_update_pre', ()),
+	('cell_eaten', ('eater_id', 'eaten_id')),
+	('death', ()),
+	('cell_removed', ('cid',)),
+	('cell_info', ('cid', 'x', 'y', 'size', 'name', 'color', 'is_virus',
+				   'is_agitated')),
+	('world_update_post', ()),
+	('leaderboard_names', ('leaderboard',)),
+	('leaderboard_groups', ('angles',)),
+	('respawn', ()),
+	('own_id', ('cid',)),
+	('world_rect', ('left', 'top', 'right', 'bottom')),
+	('server_version', ('number', 'text')),
+	('spectate_update', ('pos', 'scale')),
+	('experience_info', ('level', 'current_xp', 'next_xp')),
+	('clear_cells', ()),
+	('debug_line', ('x', 'y')),
+])
+
+def checkHandler(event, handler):
+	"""Raises TypeError unless handler can be called with event's arguments."""
+	fn = handler
+	if not (inspect.isfunction(fn) or inspect.ismethod(fn)):
+		fn = getattr(fn, '__call__', None)
+		if not inspect.ismethod(fn):
+			return  # builtin, partial, ...: nothing to inspect
+	spec = inspect.getargspec(fn)
+	args = spec.args
+	if inspect.ismethod(fn) and fn.__self__ is not None:
+		args = args[1:]
+	names = events[event]
+	required = args[:len(args) - len(spec.defaults or ())]
+	unknown = [arg for arg in required if arg not in names]
+	missing = [] if spec.keywords else [name for name in names
+										 if name not in args]
+	if unknown or missing:
+		raise TypeError('Handler %r of %r takes (%s), the event has (%s)'
+						% (handler, event, ', '.join(args), ', '.join(names)))
+
+def checkData(event, data):
+	"""Raises TypeError unless data has exactly event's arguments."""
+	if set(data) != set(events[event]):
+		raise TypeError('Event %r has (%s), got (%s)'
+						% (event, ', '.join(events[event]), ', '.join(sorted(data))))
+
+class EventBus(object):
+	def __init__(self, history=0, debug=False):
+		self.handlers = dict((event, []) for event in events)
+		self.history = deque(maxlen=history) if history else None
+		self.debug = debug
+		self.dispatch = {}
+		for event in events:
+			self.rebuild(event)
+
+	def check(self, event):
+		if event not in self.handlers:
+			raise KeyError('Unknown event %r' % event)
+
+	def rebuild(self, event):
+		handlers = tuple(self.handlers[event])
+		history = self.history
+		if self.debug:
+			def fn(**data):
+				checkData(event, data)
+				if history is not None:
+					history.append((event, data))
+				for handler in handlers:
+					handler(**data)
+		elif history is not None:
+			def fn(**data):
+				history.append((event, data))
+				for handler in handlers:
+					handler(**data)
+		elif not handlers:
+			fn = None
+		elif len(handlers) == 1:
+			fn = handlers[0]
+		else:
+			def fn(**data):
+				for handler in handlers:
+					handler(**data)
+		self.dispatch[event] = fn
+		setattr(self, 'on_' + event, fn)
+
+	#====================
+
+	def subscribe(self, event, handler):
+		"""handler is called with the event's keyword arguments."""
+		self.check(event)
+		checkHandler(event, handler)
+		self.handlers[event].append(handler)
+		self.rebuild(event)
+
+	def unsubscribe(self, event, handler):
+		self.check(event)
+		self.handlers[event].remove(handler)
+		self.rebuild(event)
+
+	def attach(self, obj):
+		"""Subscribes the on_<event> methods defined by obj's class."""
+		for event in events:
+			if getattr(type(obj), 'on_' + event, None) is not None:
+				self.subscribe(event, getattr(obj, 'on_' + event))
+
+	def emit(self, event, **data):
+		fn = self.dispatch[event]
+		if fn is not None:
+			fn(**data)
+
+	def clear_history(self):
+		if self.history is not None:
+			self.history.clear()
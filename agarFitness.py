@@ -0,0 +1,111 @@
+#! /usr/bin/python2.7
+# -*- coding: utf-8 -*-
+"""
+Fitness cache for noisy episodes.
+
+Elites and unchanged offspring come back every generation, often as
+genomes whose phenotype was already played. FitnessCache keys scores
+by a hash of what create_phenotype reads (node genes and enabled
+connections), so identical networks share one entry whatever their
+genome id, and keeps a running mean of their episode scores:
+
+	min_episodes  episodes always played before a score is reused
+	max_episodes  episodes after which the mean is final
+	rel_error     in between, one more episode is played while the
+	              standard error of the mean exceeds rel_error times
+	              the mean (or times scale, for means close to 0)
+
+Every genome gets the mean of its entry as fitness, so one lucky
+episode is averaged out instead of frozen. Entries of networks no
+longer in the population are dropped, so memory stays bounded by the
+population size:
+
+	cache = FitnessCache(max_episodes=5)
+	pop.epoch(cache.wrap(evaluator.evalFitness), 200)
+"""
+
+import hashlib
+import math
+
+import agarStats
+
+def genomeKey(genome):
+	"""Digest of the phenotype genome encodes, see nn_pure.create_phenotype."""
+	h = hashlib.sha1()
+	h.update(repr(genome.num_inputs).encode('ascii'))
+	for ng in sorted(genome.node_genes.values(), key=lambda ng: ng.ID):
+		h.update(repr((ng.ID, ng.type, ng.bias, ng.response,
+					   ng.activation_type)).encode('ascii'))
+	for cg in sorted((cg for cg in genome.conn_genes.values() if cg.enabled),
+					 key=lambda cg: (cg.in_node_id, cg.out_node_id)):
+		h.update(repr((cg.in_node_id, cg.out_node_id, cg.weight)).encode('ascii'))
+	return h.digest()
+
+class Entry:
+	"""Running mean and variance of the scores of one network (Welford)."""
+	__slots__ = ('count', 'mean', 'm2')
+
+	def __init__(self):
+		self.count = 0
+		self.mean = 0.0
+		self.m2 = 0.0
+
+	def add(self, score):
+		self.count += 1
+		delta = score - self.mean
+		self.mean += delta / self.count
+		self.m2 += delta * (score - self.mean)
+
+	def stderr(self):
+		return math.sqrt(self.m2 / (self.count - 1) / self.count)
+
+class FitnessCache:
+	def __init__(self, min_episodes=2, max_episodes=5, rel_error=0.1,
+				 scale=1.0, registry=agarStats.registry):
+		self.max_episodes = max(1, max_episodes)
+		self.min_episodes = max(1, min(min_episodes, self.max_episodes))
+		self.rel_error = rel_error
+		self.scale = scale
+		self.registry = registry
+		self.entries = {}
+
+	def needs(self, key):
+		"""Whether the network with this key should play one more episode."""
+		entry = self.entries.get(key)
+		if entry is None or entry.count < self.min_episodes:
+			return True
+		if entry.count >= self.max_episodes or entry.count < 2:
+			return False  # final, or min_episodes = 1 trusts one episode
+		return entry.stderr() > self.rel_error * max(abs(entry.mean), self.scale)
+
+	def evaluate(self, evalFitness, genomes):
+		"""
+		Runs evalFitness on one genome of each network needing an
+		episode, then sets the mean score on every genome and forgets
+		networks not among genomes.
+		"""
+		keys = [genomeKey(g) for g in genomes]
+		pending = []
+		queued = {}
+		for g, key in zip(genomes, keys):
+			if key not in queued and self.needs(key):
+				pending.append(g)
+				queued[key] = g
+		if pending:
+			evalFitness(pending)
+		for key, g in queued.items():
+			self.entries.setdefault(key, Entry()).add(g.fitness)
+		for g, key in zip(genomes, keys):
+			g.fitness = self.entries[key].mean
+		alive = set(keys)
+		for key in list(self.entries):
+			if key not in alive:
+				del self.entries[key]
+		self.registry.count('fitness.evaluated', len(pending))
+		self.registry.count('fitness.cached', len(genomes) - len(pending))
+		print("fitness cache: %i of %i genomes evaluated, %i networks cached"
+			  % (len(pending), len(genomes), len(self.entries)))
+
+	def wrap(self, evalFitness):
+		"""evalFitness, going through the cache; for pop.epoch."""
+		return lambda genomes: self.evaluate(evalFitness, genomes)
@@ -3,20 +3,30 @@
 
 import os
 import threading
+import multiprocessing
 import urllib2
 import websocket
 import struct
-from time import sleep
+import copy
+from time import sleep, time
 import pygame
 import pygame.gfxdraw
 import sys
 from threading import RLock
 import math
+import re
+from collections import OrderedDict
+import agarStats
+import numpy as np
 import matplotlib.pyplot as plt
 
 from neat import population, visualize
 from neat.config import Config
 from neat.nn import nn_pure as nn
+import agarNet
+import agarRacing
+from agarOutbox import Outbox
+from agarEvents import EventBus
 
 red = (255,0,0)
 green = (0,255,0)
@@ -31,6 +41,10 @@ gray = (100,100,100)
 
 featuresColors = [green,red,yellow,cian]
 
+stats = agarStats.registry  # set stats.enabled to record timings
+
+quit = False  # stops running episodes when set
+
 packet_s2c = {
     16: 'world_update',
     17: 'spectate_update',
@@ -70,28 +84,89 @@ handshakeVersion = 2200049715
 headers = {'User-Agent':'Mozilla/5.0 (Windows NT 6.3; rv:36.0) Gecko/20100101 Firefox/36.0',\
 			'Origin': 'http://agar.io','Referer':'http://agar.io'}
 
-class Cell:
+# cell categories, in the order of the computeFeatures groups
+CATEGORY_FOOD = 0
+CATEGORY_ENEMY = 1
+CATEGORY_VIRUS = 2
+CATEGORY_EJECTED = 3
+
+class Cell(object):
+    """
+    A cell as last seen in a world_update.
+    The category (CATEGORY_*) is decided once per update and color is
+    normalised only when read; an update that only moves the cell
+    just stores the new position.
+    gen is the World generation the cell was written in, see
+    World.share_cells.
+    """
+    __slots__ = ('cid', 'pos', 'size', 'mass', 'name', 'rgb', '_color',
+                 'is_virus', 'is_agitated', 'category', 'gen')
+
     def __init__(self, *args, **kwargs):
+        self.gen = 0
         self.pos = ()
+        self.size = 0
+        self.name = ''
+        self.rgb = None
+        self.is_virus = False
+        self.is_agitated = False
         self.update(*args, **kwargs)
 
     def update(self, cid=-1, x=0, y=0, size=0, name='',
                color=(1, 0, 1), is_virus=False, is_agitated=False): 
         self.cid = cid
         self.pos = (x, y)
+        if size == self.size and color == self.rgb \
+                and is_virus == self.is_virus \
+                and is_agitated == self.is_agitated \
+                and (self.name or not name):
+            return  # position-only update
         self.size = size
         self.mass = size ** 2 / 100.0
-        self.name = getattr(self, 'name', name) or name
-        self.color = tuple(map(lambda rgb: rgb / 255.0, color))
+        self.name = self.name or name
+        self.rgb = color
+        self._color = None
         self.is_virus = is_virus
         self.is_agitated = is_agitated
+        if self.name:
+            self.category = CATEGORY_VIRUS if is_virus else CATEGORY_ENEMY
+        elif size < 20:
+            self.category = CATEGORY_FOOD
+        elif size in (37, 38):
+            self.category = CATEGORY_EJECTED
+        elif is_virus:
+            self.category = CATEGORY_VIRUS
+        else:
+            self.category = CATEGORY_ENEMY
+
+    def copy(self):
+        other = Cell.__new__(Cell)
+        other.cid = self.cid
+        other.pos = self.pos
+        other.size = self.size
+        other.mass = self.mass
+        other.name = self.name
+        other.rgb = self.rgb
+        other._color = self._color
+        other.is_virus = self.is_virus
+        other.is_agitated = self.is_agitated
+        other.category = self.category
+        other.gen = self.gen
+        return other
+
+    @property
+    def color(self):
+        if self._color is None:
+            self._color = tuple(rgb / 255.0 for rgb in self.rgb)
+        return self._color
+
     @property
     def is_food(self):
-        return self.size < 20 and not self.name
+        return self.category == CATEGORY_FOOD
 
     @property
     def is_ejected_mass(self):
-        return self.size in (37, 38) and not self.name
+        return self.category == CATEGORY_EJECTED
 
     def same_player(self, other):
         """
@@ -109,9 +184,10 @@ class Cell:
 
 
 class World:
-	def __init__(self):
+	def __init__(self, index=None):
 		self.cells = {}
-		self.cellsMutex = RLock()
+		self.index = index  # optional SpatialGrid kept in sync with cells
+		self.cellsMutex = agarStats.TimedLock(RLock(), 'cellsMutex', stats)
 		self.cellsMutex.acquire()
 		self.cellsMutex.release()
 		self.leaderboard_names = []
@@ -122,6 +198,10 @@ class World:
 
 	def reset(self):
 		self.cells.clear()
+		if self.index is not None:
+			self.index.clear()
+		self.version = 0  # number of world updates applied
+		self.generation = 0
 		del self.leaderboard_names[:]
 		del self.leaderboard_groups[:]
 		self.top_left = (0, 0)
@@ -134,8 +214,56 @@ class World:
 		"""
 		self.cellsMutex.acquire()
 		self.cells[cid] = Cell()
+		self.cells[cid].gen = self.generation
+		if self.index is not None:
+			self.index.update(cid, self.cells[cid].category, 0, 0, 0)
 		self.cellsMutex.release()
 
+	def update_cells(self, records):
+		"""
+		Creates or updates cells from the records returned by
+		BufferStruct.pop_cell_records.
+		"""
+		cells = self.cells
+		index = self.index
+		generation = self.generation
+		for (cid, x, y, size, color, is_virus, is_agitated,
+				skin_url, name) in records:
+			if cid not in cells:
+				self.create_cell(cid)
+			cell = cells[cid]
+			if cell.gen != generation:  # shared with a snapshot
+				cell = cells[cid] = cell.copy()
+				cell.gen = generation
+			cell.update(
+				cid=cid, x=x, y=y, size=size, name=name, color=color,
+				is_virus=is_virus, is_agitated=is_agitated)
+			if index is not None:
+				index.update(cid, cell.category, x, y, size)
+
+	def remove_cell(self, cid):
+		del self.cells[cid]
+		if self.index is not None:
+			self.index.remove(cid)
+
+	def snapshot(self):
+		"""
+		Returns a read-only copy of the world (without index) that
+		later updates will not touch, see share_cells.
+		"""
+		snap = copy.copy(self)
+		snap.index = None
+		snap.leaderboard_names = list(self.leaderboard_names)
+		snap.leaderboard_groups = list(self.leaderboard_groups)
+		self.share_cells(snap)
+		return snap
+
+	def share_cells(self, snap):
+		# cells written before this are copied before their next update
+		# instead of being modified in place, so snap can keep them
+		self.generation += 1
+		snap.cells = dict(self.cells)
+
 	@property
 	def center(self):
 		return (((self.top_left[0] + self.bottom_right[0]) / 2),\
@@ -146,32 +274,519 @@ class World:
 		return (abs(self.top_left[0]) + abs(self.bottom_right[0]),\
 				abs(self.top_left[1]) + abs(self.bottom_right[1]))
 		
+
+CELL_VIRUS = 1
+CELL_AGITATED = 2
+CELL_FOOD = 4
+CELL_EJECTED = 8
+
+class ArrayCell(object):
+	"""
+	Cell-like view on one slot of an ArrayWorld, so code written
+	against World.cells keeps working with the array backend.
+	"""
+	__slots__ = ('world', 'slot')
+
+	def __init__(self, world, slot):
+		self.world = world
+		self.slot = slot
+
+	def update(self, cid=-1, x=0, y=0, size=0, name='',
+			   color=(1, 0, 1), is_virus=False, is_agitated=False):
+		self.world.update_cells([(cid, x, y, size, color,
+								  is_virus, is_agitated, '', name)])
+
+	@property
+	def cid(self):
+		return int(self.world.ids[self.slot])
+
+	@property
+	def pos(self):
+		return (int(self.world.x[self.slot]), int(self.world.y[self.slot]))
+
+	@property
+	def size(self):
+		return int(self.world.sizes[self.slot])
+
+	@property
+	def mass(self):
+		return float(self.world.mass[self.slot])
+
+	@property
+	def name(self):
+		return self.world.names[self.slot]
+
+	@property
+	def rgb(self):
+		return tuple(int(c) for c in self.world.color[self.slot])
+
+	@property
+	def color(self):
+		return tuple(rgb / 255.0 for rgb in self.world.color[self.slot])
+
+	@property
+	def is_virus(self):
+		return bool(self.world.flags[self.slot] & CELL_VIRUS)
+
+	@property
+	def is_agitated(self):
+		return bool(self.world.flags[self.slot] & CELL_AGITATED)
+
+	@property
+	def is_food(self):
+		return bool(self.world.flags[self.slot] & CELL_FOOD)
+
+	@property
+	def is_ejected_mass(self):
+		return bool(self.world.flags[self.slot] & CELL_EJECTED)
+
+	@property
+	def category(self):
+		flags = self.world.flags[self.slot]
+		if flags & CELL_FOOD:
+			return CATEGORY_FOOD
+		if flags & CELL_EJECTED:
+			return CATEGORY_EJECTED
+		if flags & CELL_VIRUS:
+			return CATEGORY_VIRUS
+		return CATEGORY_ENEMY
+
+	def same_player(self, other):
+		return self.name == other.name \
+			and self.color == other.color
+
+	def __lt__(self, other):
+		if self.mass != other.mass:
+			return self.mass < other.mass
+		return self.cid < other.cid
+
+class ArrayCells(object):
+	"""Dict-like cid -> ArrayCell mapping over an ArrayWorld."""
+	def __init__(self, world):
+		self.world = world
+
+	def __contains__(self, cid):
+		return cid in self.world.slot_of
+
+	def __getitem__(self, cid):
+		return ArrayCell(self.world, self.world.slot_of[cid])
+
+	def __delitem__(self, cid):
+		self.world.remove_cell(cid)
+
+	def __iter__(self):
+		return iter(list(self.world.slot_of))
+
+	def __len__(self):
+		return len(self.world.slot_of)
+
+	def keys(self):
+		return list(self.world.slot_of)
+
+	def values(self):
+		return [self[cid] for cid in self.keys()]
+
+	def items(self):
+		return [(cid, self[cid]) for cid in self.keys()]
+
+	def get(self, cid, default=None):
+		return self[cid] if cid in self else default
+
+	def clear(self):
+		self.world.clear_cells()
+
+class ArrayWorld(World):
+	"""
+	World keeping its cells as a struct of NumPy arrays: ids, x, y,
+	sizes, mass, flags (CELL_* bits) and color, one slot per cell.
+	Slots are found through the slot_of dict (cid -> slot) and freed
+	slots are reused. alive marks used slots, so vectorized code can
+	work on all cells at once, e.g. with live_slots().
+	cells is a dict-like view with the usual World semantics.
+	"""
+	arrays = ('ids', 'x', 'y', 'sizes', 'mass', 'flags', 'color', 'alive')
+
+	def __init__(self, capacity=1024, index=None):
+		self.capacity = capacity
+		World.__init__(self, index)
+		self.cells = ArrayCells(self)
+		self.clear_cells()
+
+	def clear_cells(self):
+		n = self.capacity
+		self.ids = np.zeros(n, dtype=np.uint32)
+		self.x = np.zeros(n, dtype=np.int32)
+		self.y = np.zeros(n, dtype=np.int32)
+		self.sizes = np.zeros(n, dtype=np.int32)
+		self.mass = np.zeros(n, dtype=np.float64)
+		self.flags = np.zeros(n, dtype=np.uint8)
+		self.color = np.zeros((n, 3), dtype=np.uint8)
+		self.alive = np.zeros(n, dtype=bool)
+		self.names = [''] * n
+		self.slot_of = {}
+		self.free = []
+		self.used = 0  # high-water mark of allocated slots
+		if self.index is not None:
+			self.index.clear()
+
+	def grow(self):
+		n = len(self.ids)
+		for attr in self.arrays:
+			old = getattr(self, attr)
+			new = np.zeros((2 * n,) + old.shape[1:], dtype=old.dtype)
+			new[:n] = old
+			setattr(self, attr, new)
+		self.names.extend([''] * n)
+
+	def allocate(self, cid):
+		if self.free:
+			slot = self.free.pop()
+		else:
+			if self.used == len(self.ids):
+				self.grow()
+			slot = self.used
+			self.used += 1
+		self.ids[slot] = cid
+		self.x[slot] = self.y[slot] = self.sizes[slot] = 0
+		self.mass[slot] = 0.0
+		self.flags[slot] = CELL_FOOD  # like a fresh Cell(): no name, size 0
+		self.color[slot] = (1, 0, 1)
+		self.alive[slot] = True
+		self.names[slot] = ''
+		self.slot_of[cid] = slot
+		return slot
+
+	def live_slots(self):
+		"""Indices of all used slots."""
+		return np.flatnonzero(self.alive[:self.used])
+
+	def create_cell(self, cid):
+		self.cellsMutex.acquire()
+		if cid not in self.slot_of:
+			self.allocate(cid)
+			if self.index is not None:
+				self.index.update(cid, CATEGORY_FOOD, 0, 0, 0)
+		self.cellsMutex.release()
+
+	def update_cells(self, records):
+		if not records:
+			return
+		slot_of = self.slot_of
+		names = self.names
+		slots = []
+		for record in records:
+			slot = slot_of.get(record[0])
+			if slot is None:
+				slot = self.allocate(record[0])
+			if not names[slot]:
+				names[slot] = record[8]
+			slots.append(slot)
+		slots = np.array(slots, dtype=np.intp)
+		size = np.array([r[3] for r in records], dtype=np.int32)
+		self.x[slots] = [r[1] for r in records]
+		self.y[slots] = [r[2] for r in records]
+		self.sizes[slots] = size
+		self.mass[slots] = size.astype(np.float64) ** 2 / 100.0
+		self.color[slots] = [r[4] for r in records]
+		unnamed = np.array([not names[slot] for slot in slots], dtype=bool)
+		flags = np.where([r[5] for r in records], CELL_VIRUS, 0) \
+			| np.where([r[6] for r in records], CELL_AGITATED, 0) \
+			| np.where(unnamed & (size < 20), CELL_FOOD, 0) \
+			| np.where(unnamed & ((size == 37) | (size == 38)), CELL_EJECTED, 0)
+		self.flags[slots] = flags
+		if self.index is not None:
+			category = np.select(
+				[flags & CELL_FOOD, flags & CELL_EJECTED, flags & CELL_VIRUS],
+				[CATEGORY_FOOD, CATEGORY_EJECTED, CATEGORY_VIRUS], CATEGORY_ENEMY)
+			update = self.index.update
+			for record, cat in zip(records, category.tolist()):
+				update(record[0], cat, record[1], record[2], record[3])
+
+	def remove_cell(self, cid):
+		slot = self.slot_of.pop(cid)
+		self.alive[slot] = False
+		self.names[slot] = ''
+		self.free.append(slot)
+		if self.index is not None:
+			self.index.remove(cid)
+
+	def share_cells(self, snap):
+		# updates write the arrays in place, so snap gets its own
+		n = self.used
+		for attr in self.arrays:
+			setattr(snap, attr, getattr(self, attr)[:n].copy())
+		snap.names = self.names[:n]
+		snap.slot_of = dict(self.slot_of)
+		snap.free = list(self.free)
+		snap.cells = ArrayCells(snap)
+
+class SpatialGrid:
+	"""
+	Uniform grid over the world cells, with separate buckets per cell
+	category (CATEGORY_*), for nearest / radius queries that only look
+	at grid squares around the query point. World keeps it in sync
+	from update_cells and remove_cell when passed as World(index=...).
+	"""
+	def __init__(self, step=300):
+		self.step = step
+		self.buckets = [{} for i in range(4)]  # category -> key -> cids
+		self.entries = {}  # cid -> (category, key, x, y, size)
+		self.clear()
+
+	def clear(self):
+		for buckets in self.buckets:
+			buckets.clear()
+		self.entries.clear()
+
+	def key(self, x, y):
+		return (int(x // self.step), int(y // self.step))
+
+	def update(self, cid, category, x, y, size):
+		key = (int(x // self.step), int(y // self.step))
+		entry = self.entries.get(cid)
+		if entry is None or entry[0] != category or entry[1] != key:
+			if entry is not None:
+				self._discard(cid, entry)
+			self.buckets[category].setdefault(key, set()).add(cid)
+		self.entries[cid] = (category, key, x, y, size)
+
+	def remove(self, cid):
+		entry = self.entries.pop(cid, None)
+		if entry is not None:
+			self._discard(cid, entry)
+
+	def _discard(self, cid, entry):
+		buckets = self.buckets[entry[0]]
+		bucket = buckets[entry[1]]
+		bucket.discard(cid)
+		if not bucket:
+			del buckets[entry[1]]
+
+	def _collect(self, cids, x, y, found, skip_center):
+		entries = self.entries
+		for cid in cids:
+			category, key, cx, cy, size = entries[cid]
+			dx = cx - x
+			dy = cy - y
+			distance = math.sqrt(dx ** 2 + dy ** 2)
+			if distance != 0 or not skip_center:
+				found.append((distance, (dx, dy), size, cid))
+
+	def nearest(self, category, x, y, k, skip_center=False):
+		"""
+		Returns the k cells of category nearest to (x, y), as sorted
+		(distance, (dx, dy), size, cid) tuples. With skip_center,
+		cells exactly at (x, y) are ignored.
+		"""
+		buckets = self.buckets[category]
+		gx, gy = self.key(x, y)
+		found = []
+		seen = 0
+		ring = 0
+		while seen < len(buckets):
+			if 8 * ring > len(buckets) - seen:
+				# sparser than the ring: scan the remaining buckets
+				for key, cids in buckets.items():
+					if max(abs(key[0] - gx), abs(key[1] - gy)) >= ring:
+						self._collect(cids, x, y, found, skip_center)
+				break
+			if ring == 0:
+				keys = [(gx, gy)]
+			else:
+				keys = [(gx + i, gy + j) for i in range(-ring, ring + 1)
+						for j in (-ring, ring)]
+				keys.extend((gx + i, gy + j) for i in (-ring, ring)
+							for j in range(-ring + 1, ring))
+			for key in keys:
+				cids = buckets.get(key)
+				if cids:
+					seen += 1
+					self._collect(cids, x, y, found, skip_center)
+			# anything not visited yet is at least ring * step away
+			if len(found) >= k:
+				found.sort()
+				if found[k - 1][0] < ring * self.step:
+					break
+			ring += 1
+		found.sort()
+		return found[:k]
+
+	def within(self, category, x, y, radius):
+		"""
+		Returns the cells of category at most radius away from (x, y),
+		as unsorted (distance, (dx, dy), size, cid) tuples.
+		"""
+		buckets = self.buckets[category]
+		gx0, gy0 = self.key(x - radius, y - radius)
+		gx1, gy1 = self.key(x + radius, y + radius)
+		found = []
+		for gx in range(gx0, gx1 + 1):
+			for gy in range(gy0, gy1 + 1):
+				cids = buckets.get((gx, gy))
+				if cids:
+					self._collect(cids, x, y, found, False)
+		return [f for f in found if f[0] <= radius]
+
+# World backends by name, see createSession and --world; sessions
+# default to array, where computeFeaturesVectorized reads the arrays
+# as they are instead of collecting them from the cells every call
+worldKinds = OrderedDict([
+	('dict', World),
+	('array', ArrayWorld),
+	('grid', lambda: World(index=SpatialGrid())),
+])
 		
 class Player:
-	def __init__(self):
-		self.world = World()
+	"""
+	Own cells and their aggregates (total size and mass, bounding box
+	center, scale). The aggregates are kept up to date incrementally
+	through add_own / remove_own / own_cells_updated; set verify to
+	cross-check them against a full recompute in cells_changed.
+	Other threads read the last published PlayerSnapshot, snapshot,
+	instead of the live state, and can wait_snapshot for the next
+	world update.
+	"""
+	def __init__(self, world=None):
+		self.world = world if world is not None else World()
+		self.published = threading.Condition()
+		self.updates = 0  # world updates published
 		self.own_ids = set()
+		self.own = {}  # cid -> (x, y, size) as counted in the aggregates
+		self.verify = False
 		self.reset()
 
 	def reset(self):
-		self.own_ids.clear()
+		self.clear_own()
 		self.nick = 'agarIAo'
 		self.center = self.world.center
 		self.cells_changed()
+		self.publish()
+
+	def clear_own(self):
+		self.own_ids.clear()
+		self.own.clear()
+		self.size_sum = 0
+		self.size_sq_sum = 0
+		self.bbox = None  # (left, top, right, bottom)
+		self.bbox_dirty = False
+
+	def _count(self, cid, x, y, size):
+		self.own[cid] = (x, y, size)
+		self.size_sum += size
+		self.size_sq_sum += size * size
+		bbox = self.bbox
+		if bbox is None:
+			self.bbox = (x, y, x, y)
+		elif not (bbox[0] <= x <= bbox[2] and bbox[1] <= y <= bbox[3]):
+			self.bbox = (min(bbox[0], x), min(bbox[1], y),
+						 max(bbox[2], x), max(bbox[3], y))
+
+	def _uncount(self, cid):
+		x, y, size = self.own.pop(cid)
+		self.size_sum -= size
+		self.size_sq_sum -= size * size
+		bbox = self.bbox
+		if not self.own:
+			self.bbox = None
+			self.bbox_dirty = False
+		elif x == bbox[0] or x == bbox[2] or y == bbox[1] or y == bbox[3]:
+			self.bbox_dirty = True  # may have been the only one on the edge
+
+	def add_own(self, cid):
+		"""The server gave us cid (respawn or split)."""
+		if cid in self.own:
+			self._uncount(cid)
+		self.own_ids.add(cid)
+		cell = self.world.cells[cid]
+		self._count(cid, cell.pos[0], cell.pos[1], cell.size)
+
+	def remove_own(self, cid):
+		"""cid got eaten or merged into another own cell."""
+		self.own_ids.remove(cid)
+		if cid in self.own:
+			self._uncount(cid)
+
+	def own_cells_updated(self, records):
+		"""Counts the new state of own cells among cell records."""
+		own = self.own
+		if not own:
+			return
+		for record in records:
+			cid = record[0]
+			if cid in own:
+				self._uncount(cid)
+				self._count(cid, record[1], record[2], record[3])
 
 	def cells_changed(self):
-		self.total_size = sum(cell.size for cell in self.own_cells)
-		self.total_mass = sum(cell.mass for cell in self.own_cells)
+		self.total_size = self.size_sum
+		self.total_mass = self.size_sq_sum / 100.0
 		self.scale = pow(min(1.0, 64.0 / self.total_size), 0.4) \
 			if self.total_size > 0 else 1.0
 			
+		if self.own:
+			if self.bbox_dirty:
+				positions = list(self.own.values())
+				self.bbox = (min(p[0] for p in positions),
+							 min(p[1] for p in positions),
+							 max(p[0] for p in positions),
+							 max(p[1] for p in positions))
+				self.bbox_dirty = False
+			left, top, right, bottom = self.bbox
+			self.center = ((left + right)/2, (top + bottom)/2)
+		else:
+			self.bbox = None
+			self.bbox_dirty = False
+		# else: keep old center
+
+		if self.verify:
+			self.check_aggregates()
+
+	def publish(self, update=False):
+		"""
+		Replaces snapshot with one of the current state. Only world
+		updates (update set) wake wait_snapshot.
+		"""
+		self.world.cellsMutex.acquire()
+		try:
+			snapshot = PlayerSnapshot(self)
+		finally:
+			self.world.cellsMutex.release()
+		with self.published:
+			if update:
+				self.updates += 1
+			snapshot.update = self.updates
+			self.snapshot = snapshot
+			if update:
+				self.published.notify_all()
+
+	def wait_snapshot(self, last=None, timeout=None):
+		"""
+		Waits until a world update newer than snapshot last is
+		published, at most timeout seconds. Returns the current
+		snapshot, or last itself on timeout.
+		"""
+		seen = last.update if last is not None else 0
+		with self.published:
+			if self.updates <= seen:
+				self.published.wait(timeout)
+			if self.updates <= seen:
+				return last
+			return self.snapshot
+
+	def check_aggregates(self):
+		"""Asserts the incremental aggregates match a full recompute."""
+		total_size = sum(cell.size for cell in self.own_cells)
+		total_mass = sum(cell.mass for cell in self.own_cells)
+		assert total_size == self.total_size, (total_size, self.total_size)
+		assert abs(total_mass - self.total_mass) <= 1e-9 * max(1.0, total_mass), \
+			(total_mass, self.total_mass)
 		if self.own_ids:
 			left = min(cell.pos[0] for cell in self.own_cells)
 			right = max(cell.pos[0] for cell in self.own_cells)
 			top = min(cell.pos[1] for cell in self.own_cells)
 			bottom = max(cell.pos[1] for cell in self.own_cells)
-			self.center = ((left + right)/2, (top + bottom)/2)
-		# else: keep old center
+			center = ((left + right)/2, (top + bottom)/2)
+			assert center == self.center, (center, self.center)
 
 	@property
 	def own_cells(self):
@@ -193,9 +808,10 @@ class Player:
 		Returns (top_left, bottom_right).
 		"""
 		# looks like zeach has a nice big screen
-		half_viewport = Vec(1920, 1080) / 2 / self.scale
-		top_left = self.world.center - half_viewport
-		bottom_right = self.world.center + half_viewport
+		half_width = 1920 / 2.0 / self.scale
+		half_height = 1080 / 2.0 / self.scale
+		top_left = (self.center[0] - half_width, self.center[1] - half_height)
+		bottom_right = (self.center[0] + half_width, self.center[1] + half_height)
 		return top_left, bottom_right
 
 class BufferUnderflowError(struct.error):
@@ -205,10 +821,48 @@ class BufferUnderflowError(struct.error):
         self.args = ('Buffer too short: wanted %i %s, got %i %s'
                      % (struct.calcsize(fmt), fmt, len(buf), buf),)
 
+_int8 = struct.Struct('<b')
+_uint8 = struct.Struct('<B')
+_int16 = struct.Struct('<h')
+_uint16 = struct.Struct('<H')
+_int32 = struct.Struct('<i')
+_uint32 = struct.Struct('<I')
+_float32 = struct.Struct('<f')
+_float64 = struct.Struct('<d')
+
+# cid, x, y, size, r, g, b, bitmask
+_cell_header = struct.Struct('<IiihBBBB')
+_target_cmd = struct.Struct('<BiiI')
+_split_cmd = struct.pack('<B', 17)
+_shoot_cmd = struct.pack('<B', 21)
+
+# run of UTF-16LE code units accepted by pop_str16, i.e. anything but
+# 0, 14 and values above 254; the first rejected unit terminates the string
+_str16_run = re.compile(b'(?:[\x01-\x0d\x0f-\xfe]\x00)*')
+
+if str is bytes:
+    _latin1 = lambda raw: raw
+else:
+    _latin1 = lambda raw: raw.decode('latin-1')
+
 class BufferStruct:
+    """
+    Reads little-endian values from a received frame.
+    The frame is wrapped in a memoryview and consumed by advancing
+    an offset, so popping a field never copies the rest of the frame.
+    """
     def __init__(self, message):
-        self.buffer = message
         self.save = message
+        self.view = memoryview(message)
+        self.offset = 0
+
+    def __len__(self):
+        return len(self.view) - self.offset
+
+    @property
+    def remaining(self):
+        """Zero-copy view of the bytes not consumed yet."""
+        return self.view[self.offset:]
 
     def __str__(self):
         specials = {
@@ -218,7 +872,7 @@ class BufferStruct:
         }
         nice_bytes = []
         hex_seen = False
-        for b in self.buffer:
+        for b in bytearray(self.remaining):
             if chr(b) in specials:
                 if hex_seen:
                     nice_bytes.append(' ')
@@ -238,75 +892,137 @@ class BufferStruct:
 
     def pop_values(self, fmt):
         size = struct.calcsize(fmt)
-        if len(self.buffer) < size:
-            raise BufferUnderflowError(fmt, self.buffer)
-        values = struct.unpack_from(fmt, self.buffer, 0)
-        self.buffer = self.buffer[size:]
+        if len(self) < size:
+            raise BufferUnderflowError(fmt, self.remaining.tobytes())
+        values = struct.unpack_from(fmt, self.view, self.offset)
+        self.offset += size
+        return values
+
+    def pop_struct(self, st):
+        """Like pop_values, with a precompiled struct.Struct."""
+        if len(self.view) - self.offset < st.size:
+            raise BufferUnderflowError(st.format, self.remaining.tobytes())
+        values = st.unpack_from(self.view, self.offset)
+        self.offset += st.size
         return values
 
+    def skip(self, size):
+        """Drops size bytes without decoding them."""
+        if len(self) < size:
+            raise BufferUnderflowError('%ix' % size, self.remaining.tobytes())
+        self.offset += size
+
     def pop_int8(self):
-        return self.pop_values('<b')[0]
+        return self.pop_struct(_int8)[0]
 
     def pop_uint8(self):
-        return self.pop_values('<B')[0]
+        return self.pop_struct(_uint8)[0]
 
     def pop_int16(self):
-        return self.pop_values('<h')[0]
+        return self.pop_struct(_int16)[0]
 
     def pop_uint16(self):
-        return self.pop_values('<H')[0]
+        return self.pop_struct(_uint16)[0]
 
     def pop_int32(self):
-        return self.pop_values('<i')[0]
+        return self.pop_struct(_int32)[0]
 
     def pop_uint32(self):
-        return self.pop_values('<I')[0]
+        return self.pop_struct(_uint32)[0]
 
     def pop_float32(self):
-        return self.pop_values('<f')[0]
+        return self.pop_struct(_float32)[0]
 
     def pop_float64(self):
-        return self.pop_values('<d')[0]
+        return self.pop_struct(_float64)[0]
 
     def pop_str16(self):
-        l_name = []
-        while 1:
-            c = self.pop_uint16()
-            if (c == 0) or (c > 254) or (c == 14):
-                break
-            l_name.append(chr(c))
-        return ''.join(l_name)
+        start = self.offset
+        end = _str16_run.match(self.save, start).end()
+        if len(self.save) - end < 2:  # no terminator left
+            raise BufferUnderflowError('<H', self.view[end:].tobytes())
+        self.offset = end + 2
+        return _latin1(self.save[start:end:2])
 
     def pop_str8(self):
-        l_name = []
+        end = self.save.find(b'\0', self.offset)
+        if end < 0:
+            raise BufferUnderflowError('<B', self.remaining.tobytes())
+        name = ''.join(map(chr, bytearray(self.view[self.offset:end])))
+        self.offset = end + 1
+        return name
+
+    def pop_cell_records(self):
+        """
+        Decodes the create/update section of a world_update packet,
+        up to and including its zero cid terminator.
+        Returns a list of
+        (cid, x, y, size, color, is_virus, is_agitated, skin_url, name).
+        """
+        records = []
+        append = records.append
+        view = self.view
+        unpack_header = _cell_header.unpack_from
+        header_size = _cell_header.size
         while 1:
-            c = self.pop_uint8()
-            if c == 0:
-                break
-            l_name.append(chr(c))
-        return ''.join(l_name)
+            offset = self.offset
+            if len(view) - offset >= header_size:
+                cid, x, y, size, r, g, b, bitmask = unpack_header(view, offset)
+                if cid == 0:
+                    self.offset = offset + 4
+                    break
+                self.offset = offset + header_size
+            else:
+                # only the terminator (or a truncated record) is left
+                if self.pop_uint32() == 0:
+                    break
+                raise BufferUnderflowError(_cell_header.format,
+                                           self.view[offset:].tobytes())
+            if bitmask & 2:  # skip padding
+                self.skip(self.pop_uint32())
+            if bitmask & 4:  # skin URL
+                skin_url = self.pop_str8()
+                if not skin_url.startswith(':'):
+                    skin_url = ''
+            else:  # no skin URL given
+                skin_url = ''
+            name = self.pop_str16()
+            append((cid, x, y, size, (r, g, b),
+                    bool(bitmask & 1), bool(bitmask & 16), skin_url, name))
+        return records
+
+def findServer(region = 'EU-London', mode = None):
+	"""Asks the master server for an (address, token) pair."""
+	print("Find Server")
+	if mode:
+		region = '%s:%s' % (region, mode)
+	data = '%s\n%s' % (region, handshakeVersion)
+	req = urllib2.Request(urlfs, data.encode(), headers)
+	return urllib2.urlopen(req).read().decode().split("\n")[0:2]
 
 class agarioClient:
-	def __init__(self, gcb = None):
+	def __init__(self, gcb = None, ws = None, world = None, history = 0,
+				 check_events = False):
 		print("Instanciate agarioClient")
 		self.inGame = False
-		self.player = Player()
-		self.ws = websocket.WebSocket()
+		self.player = Player(world)
+		# any object with the websocket.WebSocket interface used below,
+		# e.g. agarServer.LocalWebSocket for offline sessions
+		self.ws = ws if ws is not None else websocket.WebSocket()
 		self.running = True
+		# optional agarCapture.CaptureWriter, gets every frame in and out
+		self.recorder = None
+		# game events, see agarEvents; gcb's on_<event> methods are
+		# subscribed, history keeps the last events in a ring buffer,
+		# check_events checks the arguments of every event emitted
+		self.events = EventBus(history, check_events)
 		if gcb:
-			self.gameCallback = gcb
-		else:
-			self.gameCallback = self
+			self.events.attach(gcb)
 			
 	#====================
 		
 	def findServer(self, region = 'EU-London', mode = None):
-		print("Find Server")
-		if mode:
-			region = '%s:%s' % (region, mode)
-		data = '%s\n%s' % (region, handshakeVersion)
-		req = urllib2.Request(urlfs, data.encode(), headers)
-		return urllib2.urlopen(req).read().decode().split("\n")[0:2]
+		return findServer(region, mode)
 		
 	#====================	
 		
@@ -317,9 +1033,17 @@ class agarioClient:
 		except Exception:
 			self.disconnect()
 			return False
+		return self.handleMessage(msg)
+
+	def handleMessage(self, msg):
 		if not msg:
 			self.onError("message","Empty message received")
 			return False
+		if self.recorder is not None:
+			self.recorder.inbound(msg)
+		if stats.enabled:
+			stats.count('packets.in')
+			stats.count('bytes.in', len(msg))
 			
 		## Unpack and parse Msg
 		buf = BufferStruct(msg)
@@ -333,18 +1057,20 @@ class agarioClient:
 			self.inGame = True
 		parser = getattr(self, 'parse_%s' % packet_name)
 		try:
-			parser(buf)
-		except:
-			print("fuck");
-			self.player.world.cellsMutex.release()
-			return True
-		"""
-		except BufferUnderflowError as e:
-			m = 'Parsing %s packet failed: %s' % (packet_name, e.args[0])
+			if stats.enabled:
+				start = time()
+				parser(buf)
+				stats.observe('parse.' + packet_name, time() - start)
+			else:
+				parser(buf)
+		except Exception as e:
+			# parsers release cellsMutex themselves
+			m = 'Parsing %s packet failed: %s' % (packet_name, e)
 			self.onError("Message",m)
-		if len(buf.buffer) != 0:
-			#print(len(buf.buffer))
-			m = 'Buffer not empty after parsing "%s" packet (%d)' %(packet_name,len(buf.buffer))
+		"""
+		if len(buf) != 0:
+			#print(len(buf))
+			m = 'Buffer not empty after parsing "%s" packet (%d)' %(packet_name,len(buf))
 			#self.onError("Message",m)
 			#print(":".join("{:02x}".format(ord(c)) for c in msg))
 			#self.onError("DUMP",msg)
@@ -379,7 +1105,10 @@ class agarioClient:
 		"""Set up a quick connection. Returns on disconnect."""
 		import select
 		while self.ws.connected:
-			if self.running:
+			if self.running and self.ws.sock is None:
+				# in-process transport, recv() blocks by itself
+				self.onMessage()
+			elif self.running:
 				r, w, e = select.select((self.ws.sock, ), (), ())
 				if r:
 					self.onMessage()
@@ -396,78 +1125,64 @@ class agarioClient:
 	#====================
 	
 	def parse_world_update(self, buf):
-		self.gameCallback.on_world_update_pre()
+		self.events.emit('world_update_pre')
 
 		# we keep the previous world state, so
 		# handlers can print names, check own_ids, ...
 
-		self.player.world.cellsMutex.acquire()
-		
-		cells = self.player.world.cells
-
-		# ca eats cb
-		for i in range(buf.pop_uint16()):
-			ca = buf.pop_uint32()
-			cb = buf.pop_uint32()
-			self.gameCallback.on_cell_eaten(eater_id=ca, eaten_id=cb)
-			if cb in self.player.own_ids:  # we got eaten
-				if len(self.player.own_ids) <= 1:
-					self.gameCallback.on_death()
-					# do not clear all cells yet, they still get updated
-				self.player.own_ids.remove(cb)
-			if cb in cells:
-				#print('delete',cb,cells[cb].pos[0],cells[cb].pos[1])
-				self.gameCallback.on_cell_removed(cid=cb)
-				del cells[cb]
-
-		# create/update cells
-		while 1:
-			cid = buf.pop_uint32()
-			if cid == 0:
-				break
-			cx = buf.pop_int32()
-			cy = buf.pop_int32()
-			csize = buf.pop_int16()
-			color = (buf.pop_uint8(), buf.pop_uint8(), buf.pop_uint8())
-
-			bitmask = buf.pop_uint8()
-			is_virus = bool(bitmask & 1)
-			is_agitated = bool(bitmask & 16)
-			if bitmask & 2:  # skip padding
-				for i in range(buf.pop_uint32()):
-					buf.pop_uint8()
-			if bitmask & 4:  # skin URL
-				#print(":".join("{:02x}".format(ord(c)) for c in buf.save))
-				skin_url = buf.pop_str8()
-				if skin_url[0] is not ':':
-					skin_url = ''
-			else:  # no skin URL given
-				skin_url = ''
-
-			cname = buf.pop_str16()
-			self.gameCallback.on_cell_info(
-				cid=cid, x=cx, y=cy, size=csize, name=cname, color=color,
-				is_virus=is_virus, is_agitated=is_agitated)
-			if cid not in cells:
-				self.player.world.create_cell(cid)
-			self.player.world.cells[cid].update(
-				cid=cid, x=cx, y=cy, size=csize, name=cname, color=color,
-				is_virus=is_virus, is_agitated=is_agitated)
-
-		# also keep these non-updated cells
-		for i in range(buf.pop_uint32()):
-			cid = buf.pop_uint32()
-			if cid in cells:
-				self.gameCallback.on_cell_removed(cid=cid)
-				del cells[cid]
-				if cid in self.player.own_ids:  # own cells joined
-					self.player.own_ids.remove(cid)
-
-		self.player.cells_changed()
-
-		self.gameCallback.on_world_update_post()
-		
-		self.player.world.cellsMutex.release()
+		world = self.player.world
+		cells = world.cells
+		events = self.events
+		on_cell_eaten = events.on_cell_eaten  # None when nobody listens
+		on_cell_removed = events.on_cell_removed
+		on_cell_info = events.on_cell_info
+		world.cellsMutex.acquire()
+		try:
+			# ca eats cb
+			for i in range(buf.pop_uint16()):
+				ca = buf.pop_uint32()
+				cb = buf.pop_uint32()
+				if on_cell_eaten is not None:
+					on_cell_eaten(eater_id=ca, eaten_id=cb)
+				if cb in self.player.own_ids:  # we got eaten
+					if len(self.player.own_ids) <= 1:
+						self.events.emit('death')
+						# do not clear all cells yet, they still get updated
+					self.player.remove_own(cb)
+				if cb in cells:
+					#print('delete',cb,cells[cb].pos[0],cells[cb].pos[1])
+					if on_cell_removed is not None:
+						on_cell_removed(cid=cb)
+					world.remove_cell(cb)
+
+			# create/update cells
+			records = buf.pop_cell_records()
+			if on_cell_info is not None:
+				for (cid, cx, cy, csize, color, is_virus, is_agitated,
+						skin_url, cname) in records:
+					on_cell_info(
+						cid=cid, x=cx, y=cy, size=csize, name=cname, color=color,
+						is_virus=is_virus, is_agitated=is_agitated)
+			world.update_cells(records)
+			self.player.own_cells_updated(records)
+
+			# also keep these non-updated cells
+			for i in range(buf.pop_uint32()):
+				cid = buf.pop_uint32()
+				if cid in cells:
+					if on_cell_removed is not None:
+						on_cell_removed(cid=cid)
+					world.remove_cell(cid)
+					if cid in self.player.own_ids:  # own cells joined
+						self.player.remove_own(cid)
+
+			self.player.cells_changed()
+			world.version += 1
+			self.player.publish(update=True)
+
+			self.events.emit('world_update_post')
+		finally:
+			world.cellsMutex.release()
 
 	def parse_leaderboard_names(self, buf):
 		# sent every 500ms
@@ -478,7 +1193,7 @@ class agarioClient:
 		    l_id = buf.pop_uint32()
 		    l_name = buf.pop_str16()
 		    leaderboard_names.append((l_id, l_name))
-		self.gameCallback.on_leaderboard_names(leaderboard=leaderboard_names)
+		self.events.emit('leaderboard_names', leaderboard=leaderboard_names)
 		self.player.world.leaderboard_names = leaderboard_names
 
 	def parse_leaderboard_groups(self, buf):
@@ -489,38 +1204,40 @@ class agarioClient:
 		for i in range(n):
 		    angle = buf.pop_float32()
 		    leaderboard_groups.append(angle)
-		self.gameCallback.on_leaderboard_groups(angles=leaderboard_groups)
+		self.events.emit('leaderboard_groups', angles=leaderboard_groups)
 		self.player.world.leaderboard_groups = leaderboard_groups
 
 	def parse_own_id(self, buf):  # new cell ID, respawned or split
 		#print("own_id")
 		cid = buf.pop_uint32()
 		if not self.player.is_alive:  # respawned
-		    self.player.own_ids.clear()
-		    self.gameCallback.on_respawn()
+		    self.player.clear_own()
+		    self.events.emit('respawn')
 		# server sends empty name, assumes we set it here
 		if cid not in self.player.world.cells:
 		    self.player.world.create_cell(cid)
 		# self.world.cells[cid].name = self.player.nick
-		self.player.own_ids.add(cid)
+		self.player.add_own(cid)
 		self.player.cells_changed()
-		self.gameCallback.on_own_id(cid=cid)
+		self.player.publish()
+		self.events.emit('own_id', cid=cid)
 
 	def parse_world_rect(self, buf):  # world size
 		left = buf.pop_float64()
 		top = buf.pop_float64()
 		right = buf.pop_float64()
 		bottom = buf.pop_float64()
-		self.gameCallback.on_world_rect(
+		self.events.emit('world_rect',
 		    left=left, top=top, right=right, bottom=bottom)
 		self.player.world.top_left = (top, left)
 		self.player.world.bottom_right = (bottom, right)
 		self.player.center = self.player.world.center
+		self.player.publish()
 
-		if buf.buffer:
+		if len(buf):
 		    number = buf.pop_uint32()
 		    text = buf.pop_str16()
-		    self.gameCallback.on_server_version(number=number, text=text)
+		    self.events.emit('server_version', number=number, text=text)
 
 	def parse_spectate_update(self, buf):
 		# only in spectate mode
@@ -529,34 +1246,43 @@ class agarioClient:
 		scale = buf.pop_float32()
 		self.player.center.set(x, y)
 		self.player.scale = scale
-		self.gameCallback.on_spectate_update(
+		self.events.emit('spectate_update',
 		    pos=self.player.center, scale=scale)
 
 	def parse_experience_info(self, buf):
 		level = buf.pop_uint32()
 		current_xp = buf.pop_uint32()
 		next_xp = buf.pop_uint32()
-		self.gameCallback.on_experience_info(
+		self.events.emit('experience_info',
 		    level=level, current_xp=current_xp, next_xp=next_xp)
 
 	def parse_clear_cells(self, buf):
 		# TODO clear cells packet is untested
-		self.gameCallback.on_clear_cells()
-		self.world.cells.clear()
-		self.player.own_ids.clear()
+		self.events.emit('clear_cells')
+		self.player.world.cells.clear()
+		self.player.clear_own()
 		self.player.cells_changed()
+		self.player.publish()
 
 	def parse_debug_line(self, buf):
 		# TODO debug line packet is untested
 		x = buf.pop_int16()
 		y = buf.pop_int16()
-		self.gameCallback.on_debug_line(x=x, y=y)
+		self.events.emit('debug_line', x=x, y=y)
 		
 	#====================			
 			
 	def sendStruct(self, fmt, *data):
+		self.sendFrame(struct.pack(fmt, *data))
+
+	def sendFrame(self, frame):
 		if self.ws.connected:
-			self.ws.send(struct.pack(fmt, *data))
+			if self.recorder is not None:
+				self.recorder.outbound(frame)
+			if stats.enabled:
+				stats.count('packets.out')
+				stats.count('bytes.out', len(frame))
+			self.ws.send(frame)
 			
 	def sendHandshake(self):
 		self.sendStruct('<BI', 254, 5)
@@ -576,7 +1302,7 @@ class agarioClient:
 		self.sendStruct('<B%iH' % len(nick), 0, *map(ord, nick))
 
 	def sendTarget(self, x, y, cid=0):
-		self.sendStruct('<BiiI', 16, int(x), int(y), cid)
+		self.sendFrame(_target_cmd.pack(16, int(x), int(y), cid))
 
 	def sendSpectate(self):
 		self.sendStruct('<B', 1)
@@ -585,21 +1311,121 @@ class agarioClient:
 		self.sendStruct('<B', 18)
 
 	def sendSplit(self):
-		self.sendStruct('<B', 17)
+		self.sendFrame(_split_cmd)
 
 	def sendShoot(self):
-		self.sendStruct('<B', 21)
+		self.sendFrame(_shoot_cmd)
 
 	def sendExplode(self):
 		self.sendStruct('<B', 20)
-		self.onDeath()
+		self.events.emit('death')
 		
+class ClientReactor:
+	"""
+	Receives for many agarioClient connections on one thread, with a
+	single select() over their sockets instead of a listen() thread
+	per client. In-process transports (ws.sock is None) are polled
+	without blocking. After a message changed a client's world,
+	onUpdate(client) is called on the reactor thread, which is where
+	an event-driven agent decides and sends its commands.
+	"""
+	def __init__(self, onUpdate=None, timeout=0.01):
+		self.onUpdate = onUpdate
+		self.timeout = timeout
+		self.clients = []
+		self.lock = RLock()
+		self.running = True
+
+	def add(self, client):
+		"""Adds an already connected client."""
+		with self.lock:
+			self.clients.append(client)
+
+	def remove(self, client):
+		with self.lock:
+			if client in self.clients:
+				self.clients.remove(client)
+
+	def dispatch(self, client, msg=None):
+		version = client.player.world.version
+		if msg is None:
+			ok = client.onMessage()
+		else:
+			ok = client.handleMessage(msg)
+		if not client.ws.connected:
+			self.remove(client)
+		elif ok and self.onUpdate and client.player.world.version != version:
+			self.onUpdate(client)
+
+	def poll(self):
+		"""Handles at most one pending message per client."""
+		import select
+		with self.lock:
+			clients = list(self.clients)
+		busy = False
+		sockets = {}
+		for client in clients:
+			if client.ws.sock is None:
+				msg = client.ws.poll()
+				if msg is not None:
+					busy = True
+					self.dispatch(client, msg)
+				elif not client.ws.connected:
+					self.remove(client)
+			else:
+				sockets[client.ws.sock] = client
+		if not sockets:
+			if not busy:
+				sleep(self.timeout)
+			return
+		r, w, e = select.select(list(sockets), (), list(sockets),
+								0 if busy else self.timeout)
+		for sock in e:
+			client = sockets.pop(sock)
+			client.onError("socket","Select Error ... disconnect")
+			client.disconnect()
+			self.remove(client)
+		for sock in r:
+			if sock in sockets:
+				self.dispatch(sockets[sock])
+
+	def run(self):
+		while self.running:
+			self.poll()
+		with self.lock:
+			clients = list(self.clients)
+		for client in clients:
+			client.disconnect()
+
+	def stop(self):
+		self.running = False
+
+class SpriteCache:
+	"""Least recently used cache of rendered surfaces."""
+	def __init__(self, capacity=1024):
+		self.capacity = capacity
+		self.surfaces = OrderedDict()
+
+	def get(self, key, render, *args):
+		"""Returns the surface for key, rendering it with render(*args)."""
+		surface = self.surfaces.pop(key, None)
+		if surface is None:
+			surface = render(*args)
+			if len(self.surfaces) >= self.capacity:
+				self.surfaces.popitem(last=False)
+		self.surfaces[key] = surface
+		return surface
+
 class Visualization:
+	maxSpriteRadius = 128  # bigger circles are drawn directly
+
 	def __init__(self,player):
 		self.screen = pygame.display.set_mode((1900/2,1080/2))
 		self.fontSize = 15
 		self.myfont = pygame.font.SysFont("monospace", self.fontSize)
 		self.player = player
+		self.sprites = SpriteCache()
+		self.labels = SpriteCache()
 		
 	def drawBackGround(self):
 		self.screen.fill(gray)
@@ -632,49 +1458,133 @@ class Visualization:
 				pygame.draw.lines(self.screen, colors[i], True, lines, 2 )
 			i+=1
 		
+	def renderLabel(self, name, color):
+		return self.myfont.render(name, 2, color)
+
+	def renderCircle(self, size, rgb):
+		r = size // 2
+		key = (1, 2, 3) if rgb != (1, 2, 3) else (3, 2, 1)
+		surface = pygame.Surface((2 * r + 1, 2 * r + 1))
+		surface.fill(key)
+		surface.set_colorkey(key)
+		pygame.draw.circle(surface, rgb, (r, r), r)
+		return surface
+
+	def renderVirus(self, size, rgb):
+		n = 26.0
+		angle = (2.0*math.pi)/n
+		dSize = 10
+		half = size // 2 + dSize // 2 + 1
+		key = (1, 2, 3) if rgb != (1, 2, 3) else (3, 2, 1)
+		surface = pygame.Surface((2 * half + 1, 2 * half + 1))
+		surface.fill(key)
+		surface.set_colorkey(key)
+		lastXY = (((size/2) + dSize/2) * math.cos(0) + half, half)
+		for i in range(1,int(n+2)):
+			if (i%2)==0:
+				r = (size/2) + (dSize/2)
+			else:
+				r = (size/2) - (dSize/2)
+			newXY = (r * math.cos(i*angle) + half, r * math.sin(i*angle) + half)
+			pygame.draw.line(surface,rgb,newXY,lastXY)
+			lastXY = newXY
+		return surface
+
 	def drawCells(self, cells):
-		
+		center = self.player.center
+		(left, top), (right, bottom) = self.player.visible_area
 		for key in cells:
 			c = cells[key]
-			normColor = tuple(int(255*x) for x in c.color)
-			cCenter = (int(c.pos[0]/2-self.player.center[0]/2+1900/4),int(c.pos[1]/2-self.player.center[1]/2+1080/4))
-			if(c.size>0):
-				if c.is_virus:
-					n = 26.0
-					angle = (2.0*math.pi)/n
-					dSize = 10
-					lastXY = (((c.size/2) + dSize/2) * math.cos(0), ((c.size/2) + dSize/2) * math.sin(0))
-					lastXY = (lastXY[0]+cCenter[0],lastXY[1]+cCenter[1])
-					for i in range(1,int(n+2)):
-						newXY = ()
-						if (i%2)==0:
-							newXY = (\
-									((c.size/2) + (dSize/2)) * math.cos(i*angle),\
-									((c.size/2) + (dSize/2)) * math.sin(i*angle)\
-									)
-						else:
-							newXY = (\
-									((c.size/2) - (dSize/2)) * math.cos(i*angle),\
-									((c.size/2) - (dSize/2)) * math.sin(i*angle)\
-									)
-						newXY = (newXY[0]+cCenter[0],newXY[1]+cCenter[1])
-						pygame.draw.line(self.screen,normColor,newXY,lastXY)
-						#newXY = (newXY[0]+cCenter[0],newXY[1]+cCenter[1])
-						#lastXY = (lastXY[0]+cCenter[0],lastXY[1]+cCenter[1])
-						#pygame.draw.line(self.screen, normColor, newXY,lastXY)
-						lastXY = newXY
-				else:
-					pygame.draw.circle(self.screen, normColor, cCenter, c.size/2)
-					if not c.is_food and not c.is_ejected_mass:
-						label = self.myfont.render(c.name, 2, black)
-						self.screen.blit(label, cCenter)
+			if c.size <= 0:
+				continue
+			x, y = c.pos
+			if x + c.size < left or x - c.size > right \
+					or y + c.size < top or y - c.size > bottom:
+				continue  # off screen
+			cCenter = (int(x/2-center[0]/2+1900/4),int(y/2-center[1]/2+1080/4))
+			if c.is_virus:
+				sprite = self.sprites.get(('virus', c.size, c.rgb),
+										  self.renderVirus, c.size, c.rgb)
+				self.screen.blit(sprite, (cCenter[0] - sprite.get_width() // 2,
+										  cCenter[1] - sprite.get_height() // 2))
+				continue
+			if c.size // 2 <= self.maxSpriteRadius:
+				sprite = self.sprites.get(('circle', c.size, c.rgb),
+										  self.renderCircle, c.size, c.rgb)
+				self.screen.blit(sprite, (cCenter[0] - c.size // 2,
+										  cCenter[1] - c.size // 2))
 			else:
-				pass
-				#print("Wrong size?")
+				pygame.draw.circle(self.screen, c.rgb, cCenter, c.size // 2)
+			if c.name and not c.is_food and not c.is_ejected_mass:
+				label = self.labels.get((c.name, black),
+										self.renderLabel, c.name, black)
+				self.screen.blit(label, cCenter)
 		
 	def commit(self):
 		pygame.display.update()
 		
+featureCount = 3  # nearest cells kept per category
+emptyFeature = (99999, 0, 0, 0)
+inputCount = 4 * featureCount * 4 + 1
+
+class PlayerSnapshot(object):
+	"""
+	Read-only copy of a player and its world after one update, made
+	by Player.publish. Readers on other threads use player.snapshot
+	instead of holding cellsMutex. The copy has no spatial index, so
+	when the world has one, features holds the nearest cells
+	(computeFeatures) as of this update.
+	"""
+	def __init__(self, player):
+		self.world = player.world.snapshot()
+		self.cells = self.world.cells
+		self.version = self.world.version
+		self.own_ids = frozenset(player.own_ids)
+		self.center = player.center
+		self.total_size = player.total_size
+		self.total_mass = player.total_mass
+		self.scale = player.scale
+		self.visible_area = player.visible_area
+		self.is_alive = player.is_alive
+		self.features = None
+		if player.world.index is not None:
+			self.features = computeFeatures(player)
+
+class RenderThread(threading.Thread):
+	"""
+	Draws snapshots of player's world with vis at no more than fps
+	frames per second, on its own thread, so rendering never holds up
+	the agent. The agent hands over its latest features through the
+	features attribute. Closing the window stops the thread.
+	"""
+	def __init__(self, vis, player, fps=30):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.vis = vis
+		self.player = player
+		self.fps = fps
+		self.features = None
+		self.running = True
+
+	def run(self):
+		period = 1.0 / self.fps
+		while self.running:
+			start = time()
+			for event in pygame.event.get():
+				if event.type == pygame.QUIT:
+					self.running = False
+			snap = self.player.snapshot
+			self.vis.player = snap
+			self.vis.drawBackGround()
+			self.vis.drawCells(snap.cells)
+			self.vis.drawFeatures(self.features or [[], [], [], []], featuresColors)
+			self.vis.drawScore()
+			self.vis.commit()
+			sleep(max(0.0, period - (time() - start)))
+
+	def stop(self):
+		self.running = False
+
 def computeFeatures(player):
 
 	# compute neural network features
@@ -684,6 +1594,15 @@ def computeFeatures(player):
 	virus = []
 	center = player.center
 	mass = player.total_mass
+	index = player.world.index
+	if isinstance(player, PlayerSnapshot) and player.features is not None:
+		return player.features
+	if index is not None:
+		if(center[0]) != 0 and (center[1] != 0) and (mass != 0):
+			return [[f[:3] for f in index.nearest(category, center[0], center[1],
+												  featureCount, category == CATEGORY_ENEMY)]
+					for category in range(4)]
+		return [[], [], [], []]
 	if(center[0]) != 0 and (center[1] != 0) and (mass != 0):
 		for key in player.world.cells:
 			cell = player.world.cells[key]
@@ -750,55 +1669,150 @@ def computeFeatures(player):
 
 	return [food,enemy,virus,em]
 
+def _nearest(idx, distance, dx, dy, size):
+	# k nearest of idx, sorted like sorted() sorts the feature tuples
+	if len(idx) > featureCount:
+		idx = idx[np.argpartition(distance[idx], featureCount - 1)[:featureCount]]
+	idx = idx[np.lexsort((size[idx], dy[idx], dx[idx], distance[idx]))]
+	return list(zip(distance[idx].tolist(),
+					zip(dx[idx].tolist(), dy[idx].tolist()),
+					size[idx].tolist()))
+
+def computeFeaturesVectorized(player, out=None):
+	"""
+	Same result as computeFeatures, computed with one NumPy pass over
+	all cells and a partial selection of the nearest per category.
+	If out is given (a float array of inputCount), it is filled with
+	the flat network inputs, see featuresToInputs.
+	"""
+	world = player.world
+	center = player.center
+	mass = player.total_mass
+	features = [[], [], [], []]
+	if isinstance(player, PlayerSnapshot) and player.features is not None:
+		features = player.features
+	elif world.index is not None:
+		features = computeFeatures(player)  # already proportional to what's near
+	elif(center[0]) != 0 and (center[1] != 0) and (mass != 0):
+		if isinstance(world, ArrayWorld):
+			slots = world.live_slots()
+			x = world.x[slots]
+			y = world.y[slots]
+			size = world.sizes[slots]
+			flags = world.flags[slots]
+			food = (flags & CELL_FOOD) != 0
+			em = ((flags & CELL_EJECTED) != 0) & ~food
+			virus = ((flags & CELL_VIRUS) != 0) & ~food & ~em
+		else:
+			cells = list(world.cells.values())
+			n = len(cells)
+			x = np.fromiter((c.pos[0] for c in cells), np.int64, n)
+			y = np.fromiter((c.pos[1] for c in cells), np.int64, n)
+			size = np.fromiter((c.size for c in cells), np.int64, n)
+			food = np.fromiter((c.is_food for c in cells), bool, n)
+			em = np.fromiter((c.is_ejected_mass for c in cells), bool, n) & ~food
+			virus = np.fromiter((c.is_virus for c in cells), bool, n) & ~food & ~em
+		dx = x - center[0]
+		dy = y - center[1]
+		distance = np.sqrt(dx.astype(np.float64) ** 2 + dy.astype(np.float64) ** 2)
+		enemy = ~food & ~em & ~virus & (distance != 0)
+		features = [_nearest(np.flatnonzero(mask), distance, dx, dy, size)
+					for mask in (food, enemy, virus, em)]
+	if out is not None:
+		featuresToInputs(features, mass, out)
+	return features
+
+def featuresToInputs(features, mass, out=None):
+	"""
+	Flattens [food, enemy, virus, em] into the network inputs:
+	(distance, dx, dy, size) per cell, emptyFeature padding, then mass.
+	"""
+	if out is None:
+		out = np.empty(inputCount)
+	i = 0
+	for group in features:
+		for cell in group:
+			out[i:i + 4] = (cell[0], cell[1][0], cell[1][1], cell[2])
+			i += 4
+		for j in range(featureCount - len(group)):
+			out[i:i + 4] = emptyFeature
+			i += 4
+	out[i] = mass
+	return out
+
+class ConnectionLost(IOError):
+	"""The connection dropped before the episode ended: no fitness."""
+
 class SubscriberMock(object):
 	def __init__(self):
-		self.events = []
-		self.data = []
 		self.v = None
 		self.c = None
+		self.renderer = None
 		self.dead = True
+		self.respawnDelay = 2
+		self.maxRate = 0  # decisions per second, 0 = one per world update
+		self.stopRules = agarRacing.StopRules()  # none: play until death
+		self.outbox = None  # optional Outbox commands go through
+		self.server = None  # agarServer.LocalServer of a local session
+		self.findServer = None  # returns the (address, token) to reconnect to
+		self.listener = None  # thread running c.listen
+		self.attempts = 3  # episodes tried per genome in evalFitness
+		self.inputs = np.empty(inputCount)
 	
 	def setAgarIOClient(self,client):
 		self.c = client
 	
 	def setVisualisation(self,vis):
 		self.v = vis
+
+	def setRenderer(self,renderer):
+		self.renderer = renderer
 	
 	def reset(self):
-		self.events.clear()
-		self.data.clear()
-        
-	def __getattr__(self, item):
-		if str(item) == "on_death":
-			print("DEAD")
-			self.dead = True
-		assert item[:3] == 'on_', str(item)
-		assert 'error' not in item, 'Error event emitted'
-		event = item[3:]
-		data = {}
-		self.events.append(event)
-		self.data.append(data)
-		return lambda **d: data.update(d)
+		if self.c is not None:
+			self.c.events.clear_history()
 
-	"""
-	def __getattr__(self, item):
-		if str(item) == "on_death":
-			print("DEAD")
-			self.dead = True
-		assert item[:3] == 'on_', 'Requested non-event handler from subscriber'
-		assert 'error' not in item, 'Error event emitted'
-		event = item[3:]
-		data = {}
-		self.events.append(event)
-		self.data.append(data)
-		return lambda **d: data.update(d)
-	"""
-	def evalFitness(self,genomes):
+	def on_death(self):
+		print("DEAD")
+		self.dead = True
+
+	def kill(self):
+		"""Kills the cell on the local server and waits for the death."""
+		self.server.kill_player()
+		snap = self.c.player.snapshot
+		while not self.dead and self.c.ws.connected:
+			snap = self.c.player.wait_snapshot(snap, timeout=1.0)
+
+	def reconnect(self):
+		"""
+		Connects c again after its connection dropped, to the server
+		findServer() returns, with a clean world and a new listener.
+		"""
+		c = self.c
+		c.player.world.reset()
+		c.player.reset()
+		address, token = self.findServer()
+		if not c.connect(address, token):
+			raise ConnectionLost('Could not reconnect to %s' % address)
+		daemon = self.listener.daemon if self.listener is not None else True
+		self.listener = threading.Thread(target=c.listen)
+		self.listener.daemon = daemon
+		self.listener.start()
+
+	def evalFitness(self,genomes,ticks=0):
 		print("evalFitness")
 		for g in genomes:
-			net = nn.create_phenotype(g)
-			#net = nn.create_fast_feedforward_phenotype(g)
-			g.fitness = self.run(net)
+			for attempt in range(self.attempts):
+				net = agarNet.compilePhenotype(g)
+				#net = nn.create_fast_feedforward_phenotype(g)
+				try:
+					g.fitness = self.run(net, ticks)
+					break
+				except ConnectionLost as e:
+					if self.findServer is None or attempt + 1 == self.attempts:
+						raise
+					print("%s, reconnecting to play the genome again" % e)
+					self.reconnect()
 			print(g.fitness)
 			
 			"""
@@ -811,9 +1825,17 @@ class SubscriberMock(object):
 			g.fitness = 1 - math.sqrt(error / len(OUTPUTS))
 			"""
         
-	def run(self, net):
+	def run(self, net, ticks=0):
+		"""
+		Plays one episode with net until death, quit, or one of
+		stopRules fires; ticks, if set, is the decision budget.
+		On a local server, a cell still alive when the episode
+		stops is killed, so the next episode starts afresh.
+		Raises ConnectionLost if the connection drops first.
+		"""
 		self.dead = False
-		sleep(2);
+		sleep(self.respawnDelay)
+		snap = self.c.player.snapshot  # decide on world updates after it
 		self.c.sendRespawn()
 		i = 0
 		dt = 0.05
@@ -825,63 +1847,78 @@ class SubscriberMock(object):
 		
 		self.lastCenter = (0,0)
 		malus = 0
+		episode = self.stopRules.start(ticks)
+		out = self.outbox if self.outbox is not None else self.c
+		if self.outbox is not None:
+			self.outbox.reset()  # nothing left over from the last genome
+		laps = stats.laps('tick')
+		reason = None
 		
-		while (not self.dead) and (not quit):
-		
-			self.c.player.world.cellsMutex.acquire()
+		while (not self.dead) and (not quit) and self.c.ws.connected:
+			# one decision per world update
+			last = snap
+			snap = self.c.player.wait_snapshot(last, timeout=1.0)
+			if snap is last:
+				continue  # nothing new, check dead / quit again
+			if not snap.is_alive:
+				continue  # not spawned yet, nothing to decide
+			started = time()
+			laps.start()
+			if self.outbox is not None:
+				self.outbox.tick()
 	
-			features = computeFeatures(self.c.player)
-			
-			self.v.drawBackGround()
-			self.v.drawCells(c.player.world.cells)
-			self.v.drawFeatures(features,featuresColors)
-			self.v.drawScore()
+			features = computeFeaturesVectorized(snap, self.inputs)
+			laps.lap('features')
 			
-			self.v.commit()
+			if self.v is not None:
+				self.v.player = snap
+				self.v.drawBackGround()
+				self.v.drawCells(snap.cells)
+				self.v.drawFeatures(features,featuresColors)
+				self.v.drawScore()
+				
+				self.v.commit()
 			
-			self.c.player.world.cellsMutex.release()
+			if self.renderer is not None:
+				self.renderer.features = features
+			laps.lap('render')
 			
 			self.lifeTime += 1;
-			self.mass.append(self.c.player.total_mass)
-			self.size.append(self.c.player.total_size)
+			self.mass.append(snap.total_mass)
+			self.size.append(snap.total_size)
 			if len(self.mass) >= 3:
 				if self.mass[-1] != self.mass[-2]:
 					self.diffMass.append(self.mass[-1] - self.mass[-2])
 					
-			inputs = []
+			inputs = self.inputs.tolist()
 			
-			for group in features:
-				for cell in group:
-					inputs.append(cell[0])
-					inputs.append(cell[1][0])
-					inputs.append(cell[1][1])
-					inputs.append(cell[2])
-				if len(group) < 3:
-					for j in range(4*(3-len(group))):
-						if j%4 == 0:
-							inputs.append(99999)
-						else:
-							inputs.append(0)
-					
-			inputs.append(self.c.player.total_mass)
-			
-			if self.lastCenter[0] == c.player.center[0]:
+			if self.lastCenter[0] == snap.center[0]:
 				malus += 0.1
-			if self.lastCenter[1] == c.player.center[1]:
+			if self.lastCenter[1] == snap.center[1]:
 				malus += 0.1
+			
+			reason = episode.update(snap.total_mass, snap.center)
+			if reason is not None:
+				stats.count('episode.' + reason)
+				print("episode stopped: %s" % reason)
+				break
 				
 			#print(len(inputs))
 			#print(inputs)
+			laps.lap('fitness')
 			
 			output = net.sactivate(inputs)
+			laps.lap('activate')
 			print(output)
 			
 			#Apply neural network output
-			self.c.sendTarget(c.player.center[0]+50*(output[0]-0.5),c.player.center[1]+50*(output[1]-0.5))
+			out.sendTarget(snap.center[0]+50*(output[0]-0.5),snap.center[1]+50*(output[1]-0.5))
 			if output[2]>0.5:
-				self.c.sendSplit()
+				out.sendSplit()
 			if output[3]>0.5:
-				self.c.sendShoot()
+				out.sendShoot()
+			laps.lap('send')
+			laps.stop()
 			
 			"""
 			if self.c.player.total_mass != 0:
@@ -898,19 +1935,148 @@ class SubscriberMock(object):
 				print("alive")
 			#print("5")
 			i += 1
-			sleep(0.01)
+			if self.maxRate:
+				sleep(max(0.0, 1.0 / self.maxRate - (time() - started)))
 		
 		"""
 		t = range(self.lifeTime)
 		plt.plot(t, self.mass)
 		plt.show()
 		"""
+		if not (self.dead or quit or reason is not None):
+			# cut short by the transport, the score would mean nothing
+			stats.count('episode.connection_lost')
+			raise ConnectionLost('Connection lost mid-episode')
+		if reason is not None and self.server is not None:
+			self.kill()
 		
 		fitness = sum(self.diffMass) - malus
 		if fitness < 0:
 			fitness = 0
 		return fitness
 			         
+def evolve(pop, evalFitness, generations, checkpoints=None, cache=None):
+	"""
+	Runs pop.epoch for generations generations. With checkpoints (an
+	agarCheckpoint.Checkpointer), the run resumes from its last
+	checkpoint and saves one after every generation, instead of neat's
+	full checkpoints. With cache (an agarFitness.FitnessCache) known
+	networks reuse their mean score instead of playing again.
+	"""
+	if cache is not None:
+		evalFitness = cache.wrap(evalFitness)
+	if checkpoints is None:
+		pop.epoch(evalFitness, generations, checkpoint_interval = 1)
+		return
+	start = checkpoints.restore(pop)
+	pop.generation = start - 1  # epoch counts it up before evaluating
+	done = [start]
+	def evaluate(genomes):
+		# neat reproduces after evaluating, so the population of the
+		# last generation is only complete when the next one starts
+		if done[0] > start:
+			checkpoints.save(pop, done[0])
+		evalFitness(genomes)
+		done[0] += 1
+	try:
+		if start < generations:
+			pop.epoch(evaluate, generations - start,
+					  checkpoint_interval = None)
+			best = pop.most_fit_genomes[-1]
+			if best.fitness <= pop.config.max_fitness_threshold:
+				checkpoints.save(pop, done[0])  # reproduced, not stopped
+	finally:
+		checkpoints.close()
+
+def createSession(local=False, tick_rate=0, region='EU-London', mode=None,
+				  max_rate=0, stop_rules=None, servers=None, coalesce=False,
+				  send_rate=0, world='array'):
+	"""
+	Returns a headless SubscriberMock driving its own connected
+	agarioClient, with the listener running on a daemon thread.
+	world names the World backend, see worldKinds.
+	servers, an agarPool.ServerCache, saves asking the master server.
+	coalesce sends commands through an Outbox limited to send_rate
+	per second, on live servers.
+	"""
+	p = SubscriberMock()
+	p.maxRate = max_rate
+	if stop_rules is not None:
+		p.stopRules = stop_rules
+	if local:
+		from agarServer import LocalServer, LocalWebSocket
+		p.server = LocalServer(tick_rate=tick_rate)
+		c = agarioClient(p, ws=LocalWebSocket(p.server),
+						 world=worldKinds[world]())
+		p.findServer = lambda: ('local', '')
+		p.respawnDelay = 0
+	else:
+		c = agarioClient(p, world=worldKinds[world]())
+		if servers is not None:
+			p.findServer = lambda: servers.get(region, mode)
+		else:
+			p.findServer = lambda: findServer(region, mode)
+	s = p.findServer()
+	p.setAgarIOClient(c)
+	if coalesce and not local:
+		p.outbox = Outbox(c, max_rate=send_rate)
+	if not c.connect(s[0], s[1]):
+		if servers is not None:
+			servers.invalidate(region, mode)
+		raise IOError('Could not connect to %s' % s[0])
+	p.listener = threading.Thread(target=c.listen)
+	p.listener.daemon = True
+	p.listener.start()
+	return p
+
+_sessions = None  # agarPool.SessionPool of a ParallelEvaluator worker
+
+def _initSession(kwargs, spares=0, server_ttl=300.0):
+	global _sessions
+	from agarPool import ServerCache, SessionPool
+	servers = ServerCache(findServer, server_ttl)
+	_sessions = SessionPool(lambda: createSession(servers=servers, **kwargs),
+							size=1 + spares)
+
+def _evalGenome(job, attempts=3):
+	index, genome, ticks = job
+	for attempt in range(attempts):
+		net = agarNet.compilePhenotype(genome)
+		session = _sessions.checkout()
+		try:
+			return index, session.run(net, ticks)
+		except ConnectionLost as e:
+			if attempt + 1 == attempts:
+				raise
+			print("%s, playing the genome again on a fresh session" % e)
+		finally:
+			_sessions.checkin(session)
+
+class ParallelEvaluator:
+	"""
+	Evaluates genomes on several independent game sessions, one per
+	worker process, each with its own agarioClient, World and listener
+	thread. A genome goes to whichever session is free first. Each
+	worker keeps spares more sessions connected, see agarPool, so a
+	dropped session is replaced without waiting for a new connection.
+	Extra keyword arguments are passed to createSession.
+	"""
+	def __init__(self, sessions, spares=0, server_ttl=300.0, **kwargs):
+		self.sessions = sessions
+		self.pool = multiprocessing.Pool(sessions, _initSession,
+										 (kwargs, spares, server_ttl))
+
+	def evalFitness(self, genomes, ticks=0):
+		print("evalFitness (%d sessions)" % self.sessions)
+		jobs = [(index, genome, ticks) for index, genome in enumerate(genomes)]
+		for index, fitness in self.pool.imap_unordered(_evalGenome, jobs):
+			genomes[index].fitness = fitness
+			print(fitness)
+
+	def close(self):
+		self.pool.terminate()
+		self.pool.join()
+
 """
 if __name__ == "__main__":
 	import threading
@@ -927,29 +2093,166 @@ if __name__ == "__main__":
 """
 if __name__ == "__main__":
 	
+	import argparse
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--local', action='store_true',
+						help='train against agarServer.LocalServer, offline')
+	parser.add_argument('--tick-rate', type=float, default=25,
+						help='local server ticks per second, 0 = as fast as possible')
+	parser.add_argument('--sessions', type=int, default=1,
+						help='evaluate genomes on this many parallel headless sessions')
+	parser.add_argument('--world', choices=list(worldKinds), default='array',
+						help='World backend of the game sessions')
+	parser.add_argument('--sim', action='store_true',
+						help='evaluate whole generations in agarSim arenas, offline')
+	parser.add_argument('--sim-ticks', type=int, default=1500,
+						help='episode length in agarSim arenas')
+	parser.add_argument('--checkpoint', metavar='DIR',
+						help='resume from and save incremental checkpoints in DIR')
+	parser.add_argument('--fitness-episodes', type=int, default=0, metavar='N',
+						help='cache fitness as the mean of up to N episodes per network, 0 = off')
+	parser.add_argument('--fitness-error', type=float, default=0.1,
+						help='relative standard error below which a cached mean is reused')
+	parser.add_argument('--max-ticks', type=int, default=0,
+						help='end episodes after this many decisions, 0 = play until death')
+	parser.add_argument('--mass-patience', type=int, default=0,
+						help='end episodes after this many decisions without mass gain')
+	parser.add_argument('--still-patience', type=int, default=0,
+						help='end episodes after this many decisions without moving')
+	parser.add_argument('--halving', type=int, default=0, metavar='TICKS',
+						help='successive halving from TICKS decisions up to --max-ticks')
+	parser.add_argument('--spares', type=int, default=0,
+						help='connected sessions kept ready per evaluation session')
+	parser.add_argument('--server-ttl', type=float, default=300,
+						help='seconds a discovered server address and token are reused')
+	parser.add_argument('--coalesce', action='store_true',
+						help='coalesce agent commands per server tick (live servers)')
+	parser.add_argument('--send-rate', type=float, default=0,
+						help='with --coalesce, commands per second cap, 0 = no cap')
+	parser.add_argument('--event-history', type=int, default=0, metavar='N',
+						help='keep the last N game events of the main session')
+	parser.add_argument('--check-events', action='store_true',
+						help='check the arguments of every game event of the main session')
+	parser.add_argument('--headless', action='store_true',
+						help='no display, all CPU goes to evaluation')
+	parser.add_argument('--fps', type=float, default=30,
+						help='frame rate cap of the viewer')
+	parser.add_argument('--max-rate', type=float, default=0,
+						help='agent decisions per second cap, 0 = one per world update')
+	parser.add_argument('--record', metavar='PATH',
+						help='capture all packets to PATH, see agarCapture')
+	parser.add_argument('--stats', metavar='PATH',
+						help='record timings, see agarStats, and dump them to PATH on exit')
+	parser.add_argument('--stats-port', type=int,
+						help='record timings and serve them on localhost:STATS_PORT')
+	args = parser.parse_args()
+
 	# Open config File
 	local_dir = os.path.dirname(__file__)
 	config = Config(os.path.join(local_dir, 'agarIAo_config'))
 
-	pygame.init()
+	checkpoints = None
+	if args.checkpoint:
+		from agarCheckpoint import Checkpointer
+		checkpoints = Checkpointer(args.checkpoint)
+	cache = None
+	if args.fitness_episodes:
+		from agarFitness import FitnessCache
+		cache = FitnessCache(max_episodes=args.fitness_episodes,
+							 rel_error=args.fitness_error)
+	rules = agarRacing.StopRules(args.max_ticks, args.mass_patience,
+								 args.still_patience)
+	def schedule(evalFitness, max_ticks):
+		if not args.halving:
+			return evalFitness
+		return agarRacing.SuccessiveHalving(evalFitness, args.halving,
+											max_ticks).evalFitness
+
+	if args.sim:
+		from agarSim import BatchEvaluator
+		pop = population.Population(config)
+		evaluate = schedule(BatchEvaluator(args.sim_ticks).evalFitness,
+							args.sim_ticks)
+		evolve(pop, evaluate, 200, checkpoints, cache)
+		sys.exit()
+
+	if args.sessions > 1 or args.spares:
+		# the worker sessions do all the playing: no main client, viewer
+		# or listener, and the pool forks before any thread is started
+		for option in ('record', 'event_history', 'check_events'):
+			if getattr(args, option):
+				parser.error('--%s needs a single session, without --sessions '
+							 'or --spares' % option.replace('_', '-'))
+		stats.enabled = bool(args.stats or args.stats_port)
+		evaluator = ParallelEvaluator(args.sessions, spares=args.spares,
+									  server_ttl=args.server_ttl,
+									  local=args.local,
+									  tick_rate=args.tick_rate,
+									  max_rate=args.max_rate,
+									  stop_rules=rules,
+									  coalesce=args.coalesce,
+									  send_rate=args.send_rate,
+									  world=args.world)
+		if args.stats_port:
+			stats.serve(args.stats_port)
+		pop = population.Population(config)
+		evaluate = schedule(evaluator.evalFitness,
+							args.max_ticks or 16 * args.halving)
+		try:
+			evolve(pop, evaluate, 200, checkpoints, cache)
+		finally:
+			evaluator.close()
+		if args.stats:
+			stats.dump(args.stats)
+		sys.exit()
+
 	p = SubscriberMock()
-	c = agarioClient(p)
-	v = Visualization(c.player)
-	
+	p.maxRate = args.max_rate
+	p.stopRules = rules
+	if args.local:
+		from agarServer import LocalServer, LocalWebSocket
+		p.server = LocalServer(tick_rate=args.tick_rate)
+		c = agarioClient(p, ws=LocalWebSocket(p.server),
+						 world=worldKinds[args.world](), history=args.event_history,
+						 check_events=args.check_events)
+	else:
+		c = agarioClient(p, world=worldKinds[args.world](),
+						 history=args.event_history,
+						 check_events=args.check_events)
 	p.setAgarIOClient(c)
-	p.setVisualisation(v)
+	if args.coalesce and not args.local:
+		p.outbox = Outbox(c, max_rate=args.send_rate)
+	if args.record:
+		from agarCapture import CaptureWriter
+		c.recorder = CaptureWriter(args.record)
+	if args.stats or args.stats_port:
+		stats.enabled = True
+		if args.stats_port:
+			stats.serve(args.stats_port)
+	
+	if not args.headless:
+		pygame.init()
+		v = Visualization(c.player)
+		renderer = RenderThread(v, c.player, args.fps)
+		renderer.start()
+		p.setRenderer(renderer)
 	
 	quit = False
 	
-	s = c.findServer()
+	if args.local:
+		p.findServer = lambda: ('local', '')
+	else:
+		p.findServer = findServer
+	s = p.findServer()
 	print(s)
 	if c.connect(s[0],s[1]):
 		print("Client connected")
-		t1 = threading.Thread(target=c.listen)
-		t1.start()
+		p.listener = threading.Thread(target=c.listen)
+		p.listener.start()
 
 		pop = population.Population(config)
-		pop.epoch(p.evalFitness, 200,checkpoint_interval = 1)
+		evaluate = schedule(p.evalFitness, args.max_ticks or 16 * args.halving)
+		evolve(pop, evaluate, 200, checkpoints, cache)
 		
 		"""
 		i = 0
@@ -987,8 +2290,17 @@ if __name__ == "__main__":
 			
 			
 		c.running = False
-		t1.join()
-		pygame.quit()
+		if args.local:
+			c.disconnect()  # wakes the listener blocked in recv()
+		p.listener.join()
+		if c.recorder is not None:
+			c.recorder.close()
+		if args.stats:
+			stats.dump(args.stats)
+		if not args.headless:
+			renderer.stop()
+			renderer.join()
+			pygame.quit()
 		sys.exit()
 	else:
 		print("Could not connect")
@@ -0,0 +1,159 @@
+#! /usr/bin/python2.7
+# -*- coding: utf-8 -*-
+"""
+NEAT phenotypes compiled to NumPy.
+
+nn_pure's Network.sactivate updates one neuron at a time in Python.
+CompiledNetwork does the same serial update with a few matrix
+products: the non-input neurons are cut into layers, runs of
+consecutive neurons none of which reads a neuron updated before it
+in the same run. A layer only sees the state left by the previous
+layers, exactly like its neurons would one by one, so recurrent
+connections (feedforward = 0) keep their one step delay and the
+outputs match sactivate up to float rounding.
+
+	net = compilePhenotype(genome)
+	output = net.sactivate(inputs)
+
+NetworkBatch activates many compiled networks at once, one row of
+inputs each, stacking the weights of networks with the same layout.
+"""
+
+import numpy as np
+
+from neat.nn import nn_pure as nn
+
+def activate(x, response, is_tanh):
+	"""
+	nn_pure's sigmoids for arrays of bias + weighted inputs x:
+	exp_sigmoid, or tanh_sigmoid where is_tanh, which indexes the last
+	axis of x and response.
+	"""
+	z = np.clip(x * response, -60.0, 60.0)
+	if is_tanh is None:  # all exp_sigmoid, the usual case
+		return 1.0 / (1.0 + np.exp(-z))
+	out = np.empty_like(z)
+	sig = ~is_tanh
+	out[..., sig] = 1.0 / (1.0 + np.exp(-z[..., sig]))
+	out[..., is_tanh] = np.tanh(z[..., is_tanh])
+	return out
+
+class CompiledNetwork(object):
+	"""
+	Drop-in replacement of an nn_pure Network, built from it.
+	state holds the output of every neuron, inputs first, in the
+	network's neuron order, and persists between sactivate calls.
+	"""
+	def __init__(self, net):
+		neurons = net.neurons
+		self.num_inputs = net._num_inputs
+		position = dict((n.ID, i) for i, n in enumerate(neurons))
+		size = len(neurons)
+		self.state = np.zeros(size)
+		input_slots = [i for i, n in enumerate(neurons[:self.num_inputs])
+					   if n.type == 'INPUT']
+		self.input_count = len(input_slots)
+		if input_slots == list(range(self.input_count)):
+			input_slots = slice(0, self.input_count)  # the usual layout
+		self.input_slots = input_slots
+		self.output_slots = np.array([i for i, n in enumerate(neurons)
+									  if n.type == 'OUTPUT'], dtype=np.intp)
+		for n in neurons[self.num_inputs:]:
+			if n.activation not in (nn.exp_sigmoid, nn.tanh_sigmoid):
+				raise NameError('Invalid activation function: %r' % n.activation)
+		self.layers = []
+		start = self.num_inputs
+		while start < size:
+			end = start + 1
+			while end < size and not any(
+					start <= position[s.source.ID] < end
+					for s in neurons[end]._synapses):
+				end += 1
+			self.layers.append(self.compile_layer(neurons, position, start, end))
+			start = end
+
+	@staticmethod
+	def compile_layer(neurons, position, start, end):
+		rows = neurons[start:end]
+		weights = np.zeros((end - start, len(neurons)))
+		for i, n in enumerate(rows):
+			for s in n._synapses:
+				weights[i, position[s.source.ID]] += s.weight
+		bias = np.array([n.bias for n in rows], dtype=np.float64)
+		response = np.array([n.response for n in rows], dtype=np.float64)
+		is_tanh = np.array([n.activation is nn.tanh_sigmoid for n in rows], dtype=bool)
+		if not is_tanh.any():
+			is_tanh = None
+		return start, end, weights, bias, response, is_tanh
+
+	def reset(self):
+		self.state[:] = 0.0
+
+	def sactivate(self, inputs):
+		state = self.state
+		state[self.input_slots] = inputs[:self.input_count]
+		for start, end, weights, bias, response, is_tanh in self.layers:
+			state[start:end] = activate(weights.dot(state) + bias,
+										response, is_tanh)
+		return state[self.output_slots].tolist()
+
+	@property
+	def layout(self):
+		"""Networks with equal layouts can be stacked, see NetworkBatch."""
+		inputs = self.input_slots
+		if isinstance(inputs, slice):
+			inputs = list(range(self.input_count))
+		return (len(self.state), tuple(inputs), tuple(self.output_slots),
+				tuple((start, end, None if is_tanh is None else tuple(is_tanh))
+					  for start, end, weights, bias, response, is_tanh
+					  in self.layers))
+
+class NetworkBatch(object):
+	"""
+	Activates a list of CompiledNetworks together: sactivate takes
+	one row of inputs per network and returns one row of outputs per
+	network, same as calling each one's sactivate. Networks with the
+	same layout (all of a fresh population, usually) are evaluated
+	as one stack, with one batched matrix product per layer.
+	"""
+	def __init__(self, nets):
+		self.nets = nets
+		groups = {}
+		for i, net in enumerate(nets):
+			groups.setdefault(net.layout, []).append(i)
+		self.groups = []
+		for layout, members in groups.items():
+			first = nets[members[0]]
+			layers = []
+			for k, (start, end, weights, bias, response, is_tanh) \
+					in enumerate(first.layers):
+				layers.append((start, end,
+					np.array([nets[i].layers[k][2] for i in members]),
+					np.array([nets[i].layers[k][3] for i in members]),
+					np.array([nets[i].layers[k][4] for i in members]),
+					is_tanh))
+			state = np.array([nets[i].state for i in members])
+			self.groups.append((np.array(members, dtype=np.intp),
+								first.input_slots, first.input_count,
+								first.output_slots, layers, state))
+		self.output_count = len(nets[0].output_slots) if nets else 0
+
+	def reset(self):
+		for group in self.groups:
+			group[-1][:] = 0.0
+
+	def sactivate(self, inputs):
+		"""inputs is an array of shape (len(nets), input count)."""
+		out = np.empty((len(self.nets), self.output_count))
+		for members, input_slots, input_count, output_slots, layers, state \
+				in self.groups:
+			state[:, input_slots] = inputs[members, :input_count]
+			for start, end, weights, bias, response, is_tanh in layers:
+				x = np.matmul(weights, state[:, :, None])[:, :, 0] + bias
+				state[:, start:end] = activate(x, response, is_tanh)
+			out[members] = state[:, output_slots]
+		return out
+
+def compilePhenotype(genome):
+	"""Like nn.create_phenotype, returns a CompiledNetwork."""
+	return CompiledNetwork(nn.create_phenotype(genome))
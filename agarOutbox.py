@@ -0,0 +1,123 @@
+#! /usr/bin/python2.7
+# -*- coding: utf-8 -*-
+"""
+Coalesced, rate limited agent commands.
+
+Outbox stands in for the agarioClient the agent sends through
+(sendTarget, sendSplit, sendShoot) and sends at most one command of
+each kind per server tick:
+
+	- a target within min_move of the last one sent is dropped,
+	  along with any pending one
+	- the first command of a kind in a tick is sent right away; a
+	  later target replaces the pending one, a later split or shoot
+	  is dropped
+	- with max_rate, commands go out at most max_rate per second
+	  (bursts of burst); the others wait for a following tick
+
+tick() starts a new server tick and sends what is pending; the agent
+calls it once per world update it sees, from the thread it sends on,
+and reset() when it starts playing a new episode:
+
+	out = Outbox(client, max_rate=30)
+	out.reset()
+	...
+	out.tick()
+	out.sendTarget(x, y)
+
+A lockstep LocalServer steps on every command it receives, so a
+dropped target would stall it; use Outbox with live servers only.
+"""
+
+from collections import OrderedDict
+from time import time
+
+import agarStats
+
+class Outbox:
+	def __init__(self, client, min_move=1, max_rate=0, burst=3,
+				 registry=agarStats.registry):
+		self.client = client
+		self.min_move = min_move
+		self.max_rate = max_rate
+		self.burst = burst
+		self.registry = registry
+		self.tokens = float(burst)
+		self.refilled = time()
+		self.sent = set()  # kinds sent in this tick
+		self.pending = OrderedDict()  # kind -> arguments
+		self.last_target = None
+		self.senders = {
+			'target': client.sendTarget,
+			'split': client.sendSplit,
+			'shoot': client.sendShoot,
+		}
+
+	#====================
+
+	def reset(self):
+		"""
+		Forgets pending commands and the last target, e.g. when a new
+		episode starts; the rate limit carries on.
+		"""
+		self.sent.clear()
+		self.pending.clear()
+		self.last_target = None
+
+	def allow(self):
+		"""Takes a send from the rate limit, if one is left."""
+		if not self.max_rate:
+			return True
+		now = time()
+		self.tokens = min(self.burst,
+						  self.tokens + (now - self.refilled) * self.max_rate)
+		self.refilled = now
+		if self.tokens < 1:
+			return False
+		self.tokens -= 1
+		return True
+
+	def send(self, kind, args):
+		self.senders[kind](*args)
+		self.sent.add(kind)
+		if kind == 'target':
+			self.last_target = args
+		self.registry.count('outbox.sent')
+
+	def submit(self, kind, args):
+		if kind in self.pending or kind in self.sent:
+			if kind == 'target':
+				self.pending[kind] = args
+			self.registry.count('outbox.coalesced')
+		elif self.allow():
+			self.send(kind, args)
+		else:
+			self.pending[kind] = args
+			self.registry.count('outbox.deferred')
+
+	def tick(self):
+		"""A new server tick: sends pending commands the rate allows."""
+		self.sent.clear()
+		for kind in list(self.pending):
+			if not self.allow():
+				break
+			self.send(kind, self.pending.pop(kind))
+
+	#====================
+
+	def sendTarget(self, x, y):
+		target = (int(x), int(y))
+		last = self.last_target
+		if last is not None and abs(target[0] - last[0]) <= self.min_move \
+				and abs(target[1] - last[1]) <= self.min_move:
+			# the server already steers there, drop any pending change too
+			self.pending.pop('target', None)
+			self.registry.count('outbox.deduplicated')
+			return
+		self.submit('target', target)
+
+	def sendSplit(self):
+		self.submit('split', ())
+
+	def sendShoot(self):
+		self.submit('shoot', ())
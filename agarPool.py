@@ -0,0 +1,158 @@
+#! /usr/bin/python2.7
+# -*- coding: utf-8 -*-
+"""
+Ready game sessions for evaluators.
+
+ServerCache keeps the (address, token) pair discovered for each
+region and mode for ttl seconds, so reconnecting does not query the
+master server every time.
+
+SessionPool keeps size sessions connected (handshake and token sent,
+listener running) from factory, normally agarIAo.createSession. An
+evaluator checks one out, plays an episode and checks it back in. A
+session found dead is dropped and replaced on a background thread,
+waiting backoff seconds after a failed connection, doubling up to
+max_backoff:
+
+	servers = ServerCache(agarIAo.findServer)
+	pool = SessionPool(lambda: createSession(servers=servers), size=2)
+	session = pool.checkout()
+	try:
+		fitness = session.run(net)
+	finally:
+		pool.checkin(session)
+"""
+
+import threading
+from collections import deque
+from time import time
+
+import agarStats
+
+class ServerCache:
+	def __init__(self, find, ttl=300.0):
+		self.find = find
+		self.ttl = ttl
+		self.entries = {}  # (region, mode) -> ((address, token), found at)
+		self.lock = threading.Lock()
+
+	def get(self, region, mode=None):
+		key = (region, mode)
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is not None and time() - entry[1] < self.ttl:
+				return entry[0]
+		server = tuple(self.find(region, mode))
+		with self.lock:
+			self.entries[key] = (server, time())
+		return server
+
+	def invalidate(self, region, mode=None):
+		"""Forgets the pair, e.g. after connecting to it failed."""
+		with self.lock:
+			self.entries.pop((region, mode), None)
+
+def sessionAlive(session):
+	return session.c.ws.connected
+
+def closeSession(session):
+	session.c.running = False
+	if session.c.ws.connected:
+		session.c.disconnect()
+
+class SessionPool:
+	def __init__(self, factory, size=2, backoff=1.0, max_backoff=60.0,
+				 alive=sessionAlive, close=closeSession,
+				 registry=agarStats.registry):
+		self.factory = factory
+		self.size = max(1, size)
+		self.backoff = backoff
+		self.max_backoff = max_backoff
+		self.alive = alive
+		self.close_session = close
+		self.registry = registry
+		self.ready = deque()
+		self.busy = 0  # checked out
+		self.running = True
+		self.cond = threading.Condition()
+		self.filler = threading.Thread(target=self.fill_loop)
+		self.filler.daemon = True
+		self.filler.start()
+
+	#====================
+
+	def prune(self):
+		"""Drops dead ready sessions; call with cond held."""
+		for session in [s for s in self.ready if not self.alive(s)]:
+			self.ready.remove(session)
+			self.registry.count('pool.dropped')
+
+	def fill_loop(self):
+		delay = 0.0
+		while True:
+			with self.cond:
+				while self.running:
+					self.prune()
+					if len(self.ready) + self.busy < self.size:
+						break
+					self.cond.wait(1.0)
+				if not self.running:
+					return
+			try:
+				session = self.factory()
+			except Exception as e:
+				delay = min(self.max_backoff, 2 * delay or self.backoff)
+				self.registry.count('pool.failures')
+				print("session pool: %s, retrying in %.1fs" % (e, delay))
+				with self.cond:
+					if self.running:
+						self.cond.wait(delay)
+				continue
+			delay = 0.0
+			self.registry.count('pool.connected')
+			with self.cond:
+				if not self.running:
+					self.close_session(session)
+					return
+				self.ready.append(session)
+				self.cond.notify_all()
+
+	#====================
+
+	def checkout(self, timeout=None):
+		"""A ready session, waiting for one if needed; None on timeout."""
+		start = time()
+		with self.cond:
+			while True:
+				self.prune()
+				if self.ready:
+					session = self.ready.popleft()
+					self.busy += 1
+					self.cond.notify_all()
+					self.registry.observe('pool.checkout', time() - start)
+					return session
+				remaining = None if timeout is None else timeout - (time() - start)
+				if remaining is not None and remaining <= 0:
+					return None
+				# Condition.wait without timeout ignores KeyboardInterrupt on py2
+				self.cond.wait(1.0 if remaining is None else min(1.0, remaining))
+
+	def checkin(self, session):
+		with self.cond:
+			self.busy -= 1
+			if self.running and self.alive(session):
+				self.ready.appendleft(session)  # warm, play it next
+			else:
+				self.registry.count('pool.dropped')
+				self.close_session(session)
+			self.cond.notify_all()
+
+	def close(self):
+		with self.cond:
+			self.running = False
+			sessions = list(self.ready)
+			self.ready.clear()
+			self.cond.notify_all()
+		for session in sessions:
+			self.close_session(session)
+		self.filler.join()
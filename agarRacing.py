@@ -0,0 +1,93 @@
+#! /usr/bin/python2.7
+# -*- coding: utf-8 -*-
+"""
+Cutting episode evaluations short.
+
+StopRules ends an episode before the agent dies, once it stops
+making progress; 0 disables a rule:
+
+	max_ticks       decisions per episode (the budget)
+	mass_patience   decisions without a new highest total mass
+	still_patience  decisions with the center staying within min_move
+	                of where it stood when the count started
+
+SuccessiveHalving spends little on obviously bad genomes: every
+genome first plays first_ticks decisions, then the best 1/eta play
+again with eta times the budget, and so on up to max_ticks. A genome
+keeps the fitness of the last episode it played. Any evalFitness
+taking a tick budget works:
+
+	halving = SuccessiveHalving(p.evalFitness, 100, 1600)
+	pop.epoch(halving.evalFitness, 200)
+
+A live server ignores respawns while the cell is alive, so after an
+episode cut short the next genome takes over the same cell. Fitness
+only counts the mass it gains itself, but it starts with the mass and
+position the previous genome left: rankings are biased toward genomes
+played after good ones, and noisier at short budgets. Sessions on a
+LocalServer kill the cell when an episode stops early instead, so
+every genome starts from a fresh cell.
+"""
+
+import math
+
+class StopRules:
+	def __init__(self, max_ticks=0, mass_patience=0, still_patience=0,
+				 min_move=5.0):
+		self.max_ticks = max_ticks
+		self.mass_patience = mass_patience
+		self.still_patience = still_patience
+		self.min_move = min_move
+
+	def start(self, max_ticks=0):
+		"""A monitor for one episode; max_ticks, if set, overrides the budget."""
+		return Episode(self, max_ticks or self.max_ticks)
+
+class Episode:
+	"""Feed update() once per decision; it returns why to stop, or None."""
+	def __init__(self, rules, max_ticks):
+		self.rules = rules
+		self.max_ticks = max_ticks
+		self.tick = 0
+		self.best_mass = None
+		self.gained_at = 0
+		self.anchor = None
+		self.moved_at = 0
+
+	def update(self, mass, center):
+		rules = self.rules
+		self.tick += 1
+		if self.best_mass is None or mass > self.best_mass:
+			self.best_mass = mass
+			self.gained_at = self.tick
+		if self.anchor is None or math.hypot(center[0] - self.anchor[0],
+				center[1] - self.anchor[1]) > rules.min_move:
+			self.anchor = center
+			self.moved_at = self.tick
+		if self.max_ticks and self.tick >= self.max_ticks:
+			return 'budget'
+		if rules.mass_patience and self.tick - self.gained_at >= rules.mass_patience:
+			return 'no_mass_gain'
+		if rules.still_patience and self.tick - self.moved_at >= rules.still_patience:
+			return 'not_moving'
+		return None
+
+class SuccessiveHalving:
+	def __init__(self, evalFitness, first_ticks=100, max_ticks=1600, eta=2):
+		self.play = evalFitness
+		self.first_ticks = first_ticks
+		self.max_ticks = max(first_ticks, max_ticks)
+		self.eta = eta
+
+	def evalFitness(self, genomes):
+		remaining = list(genomes)
+		ticks = self.first_ticks
+		while True:
+			self.play(remaining, ticks)
+			if ticks >= self.max_ticks or len(remaining) <= 1:
+				break
+			remaining.sort(key=lambda g: g.fitness, reverse=True)
+			remaining = remaining[:max(1, len(remaining) // self.eta)]
+			ticks = min(self.max_ticks, ticks * self.eta)
+			print("successive halving: %i genomes go on to %i ticks"
+				  % (len(remaining), ticks))
@@ -0,0 +1,570 @@
+#! /usr/bin/python2.7
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for an agar.io server, for offline training.
+
+LocalServer simulates a single player arena (food, viruses, wandering
+enemy bots) and speaks the binary protocol of agarIAo.agarioClient.
+LocalWebSocket exposes it through the subset of websocket.WebSocket
+the client uses, so no socket or network is involved:
+
+	server = LocalServer(tick_rate=0)  # as fast as possible
+	c = agarioClient(p, ws=LocalWebSocket(server))
+	c.connect('local', '')
+"""
+
+import math
+import random
+import struct
+import threading
+from collections import deque
+from time import time
+
+from agarIAo import packet_c2s
+
+FOOD = 0
+VIRUS = 1
+BOT = 2
+PLAYER = 3
+EJECTED = 4
+
+foodSize = 10
+virusSize = 100
+ejectedSize = 38
+ejectedMass = ejectedSize ** 2 / 100.0
+playerStartMass = 10.0
+botStartMass = 10.0
+splitMinMass = 36.0
+shootMinMass = 35.0
+maxPlayerCells = 16
+mergeTicks = 750  # 30s at 25 ticks/s
+gridStep = 200.0
+
+viewport = (1920, 1080)
+
+def sizeOf(mass):
+	return math.sqrt(mass * 100.0)
+
+def encodeStr16(name):
+	return struct.pack('<%iH' % len(name), *map(ord, name)) + b'\0\0'
+
+class ServerCell(object):
+	__slots__ = ('cid', 'kind', 'x', 'y', 'mass', 'size', 'color', 'name',
+				 'vx', 'vy', 'merge_tick', 'target')
+
+	def __init__(self, cid, kind, x, y, mass, color, name=''):
+		self.cid = cid
+		self.kind = kind
+		self.x = x
+		self.y = y
+		self.set_mass(mass)
+		self.color = color
+		self.name = name
+		self.vx = 0.0
+		self.vy = 0.0
+		self.merge_tick = 0
+		self.target = (x, y)
+
+	def set_mass(self, mass):
+		self.mass = mass
+		self.size = sizeOf(mass)
+
+	@property
+	def speed(self):
+		return 80.0 * pow(self.size, -0.439)
+
+class LocalServer:
+	"""
+	Single player game state stepped one tick at a time.
+	Client packets go in through receive(), server packets come out
+	of the outbox deque as raw frames.
+	tick_rate is in ticks per second; 0 or None runs as fast as the
+	consumer reads. With lockstep, a fast server waits (up to
+	lockstep_timeout seconds) for the agent's next command before
+	stepping again, so decisions are not outrun by the simulation.
+	"""
+	def __init__(self, tick_rate=25, food=1000, viruses=20, bots=10,
+				 world_size=6000.0, lockstep=True, lockstep_timeout=1.0,
+				 leaderboard_interval=12, seed=None):
+		self.tick_rate = tick_rate
+		self.food_count = food
+		self.virus_count = viruses
+		self.bot_count = bots
+		self.world_size = float(world_size)
+		self.lockstep = lockstep
+		self.lockstep_timeout = lockstep_timeout
+		self.leaderboard_interval = leaderboard_interval
+		self.random = random.Random(seed)
+		self.outbox = deque()
+		self.cond = threading.Condition()
+		self.reset()
+
+	def reset(self):
+		self.tick = 0
+		self.next_cid = 1
+		self.cells = {}
+		self.food_grid = {}
+		self.bots = []
+		self.viruses = []
+		self.ejected = []
+		self.player_cells = []
+		self.target = (0.0, 0.0)
+		self.nick = ''
+		self.known = set()
+		self.own_sent = set()  # own ids announced with own_id
+		self.eats = []
+		self.dirty = set()
+		self.next_tick = 0.0
+		self.awaiting_command = False
+		self.awaiting_since = 0.0
+		self.outbox.clear()
+		for i in range(self.food_count):
+			self.spawn_food()
+		for i in range(self.virus_count):
+			x, y = self.random_pos()
+			self.viruses.append(self.add_cell(VIRUS, x, y,
+				virusSize ** 2 / 100.0, (51, 255, 51)))
+		for i in range(self.bot_count):
+			self.spawn_bot()
+
+	@property
+	def is_realtime(self):
+		return bool(self.tick_rate)
+
+	@property
+	def player_alive(self):
+		return bool(self.player_cells)
+
+	#====================
+
+	def random_pos(self):
+		return (self.random.uniform(0, self.world_size),
+				self.random.uniform(0, self.world_size))
+
+	def random_color(self):
+		c = [self.random.randint(0, 255) for i in range(3)]
+		c[self.random.randint(0, 2)] = 255
+		return tuple(c)
+
+	def add_cell(self, kind, x, y, mass, color, name=''):
+		cell = ServerCell(self.next_cid, kind, x, y, mass, color, name)
+		self.next_cid += 1
+		self.cells[cell.cid] = cell
+		self.dirty.add(cell.cid)
+		return cell
+
+	def grid_key(self, x, y):
+		return (int(x // gridStep), int(y // gridStep))
+
+	def spawn_food(self):
+		x, y = self.random_pos()
+		cell = self.add_cell(FOOD, x, y, foodSize ** 2 / 100.0,
+							 self.random_color())
+		self.food_grid.setdefault(self.grid_key(x, y), set()).add(cell)
+
+	def spawn_bot(self):
+		x, y = self.random_pos()
+		bot = self.add_cell(BOT, x, y, botStartMass, self.random_color(),
+							'bot%i' % (len(self.bots) + 1))
+		self.bots.append(bot)
+
+	def food_near(self, x0, y0, x1, y1):
+		gx0, gy0 = self.grid_key(x0, y0)
+		gx1, gy1 = self.grid_key(x1, y1)
+		grid = self.food_grid
+		for gx in range(gx0, gx1 + 1):
+			for gy in range(gy0, gy1 + 1):
+				bucket = grid.get((gx, gy))
+				if bucket:
+					for cell in bucket:
+						yield cell
+
+	def remove_cell(self, cell):
+		del self.cells[cell.cid]
+		self.dirty.discard(cell.cid)
+		if cell.kind == FOOD:
+			self.food_grid[self.grid_key(cell.x, cell.y)].discard(cell)
+			self.spawn_food()
+		elif cell.kind == BOT:
+			self.bots.remove(cell)
+			self.spawn_bot()
+		elif cell.kind == VIRUS:
+			self.viruses.remove(cell)
+			x, y = self.random_pos()
+			self.viruses.append(self.add_cell(VIRUS, x, y,
+				virusSize ** 2 / 100.0, (51, 255, 51)))
+		elif cell.kind == EJECTED:
+			self.ejected.remove(cell)
+		elif cell.kind == PLAYER:
+			self.player_cells.remove(cell)
+
+	def kill_player(self):
+		"""
+		Removes the player's cells as if they were eaten (by cid 0) and
+		tells the client, so the next respawn starts from a fresh cell.
+		For agents ending an episode before the player dies.
+		"""
+		with self.cond:
+			if not self.player_alive:
+				return
+			for cell in list(self.player_cells):
+				self.eats.append((0, cell.cid))
+				self.remove_cell(cell)
+			self.send_world_update()
+			self.cond.notify_all()
+
+	#==================== client -> server
+
+	def connect(self):
+		with self.cond:
+			self.reset()
+			self.next_tick = time()
+
+	def receive(self, frame):
+		opcode = bytearray(frame[:1])[0]
+		name = packet_c2s.get(opcode)
+		handler = getattr(self, 'on_%s' % name, None)
+		with self.cond:
+			if handler:
+				handler(frame)
+			self.awaiting_command = False
+			self.cond.notify_all()
+
+	def on_handshake1(self, frame):
+		pass
+
+	def on_handshake2(self, frame):
+		pass
+
+	def on_token(self, frame):
+		self.send_world_rect()
+
+	def on_respawn(self, frame):
+		n = (len(frame) - 1) // 2
+		self.nick = ''.join(map(chr, struct.unpack_from('<%iH' % n, frame, 1)))
+		if self.player_alive:
+			return
+		x, y = self.random_pos()
+		cell = self.add_cell(PLAYER, x, y, playerStartMass,
+							 self.random_color(), self.nick)
+		self.player_cells.append(cell)
+		self.target = (x, y)
+		self.send_own_id(cell.cid)
+		self.next_tick = time()
+
+	def on_target(self, frame):
+		opcode, x, y, cid = struct.unpack('<BiiI', frame)
+		self.target = (float(x), float(y))
+
+	def on_split(self, frame):
+		for cell in list(self.player_cells):
+			if len(self.player_cells) >= maxPlayerCells:
+				break
+			if cell.mass >= splitMinMass:
+				self.split_cell(cell, self.target, cell.mass / 2)
+
+	def on_shoot(self, frame):
+		for cell in self.player_cells:
+			if cell.mass < shootMinMass:
+				continue
+			dx, dy, d = self.direction(cell, self.target)
+			cell.set_mass(cell.mass - ejectedMass)
+			em = self.add_cell(EJECTED, cell.x + dx * cell.size,
+							   cell.y + dy * cell.size, ejectedMass, cell.color)
+			em.vx = dx * 60.0
+			em.vy = dy * 60.0
+			self.ejected.append(em)
+			self.dirty.add(cell.cid)
+
+	#==================== physics
+
+	def direction(self, cell, target):
+		dx = target[0] - cell.x
+		dy = target[1] - cell.y
+		d = math.sqrt(dx * dx + dy * dy)
+		if d == 0:
+			return 0.0, 0.0, 0.0
+		return dx / d, dy / d, d
+
+	def split_cell(self, cell, target, mass):
+		dx, dy, d = self.direction(cell, target)
+		if d == 0:
+			dx = 1.0
+		cell.set_mass(cell.mass - mass)
+		piece = self.add_cell(PLAYER, cell.x, cell.y, mass, cell.color,
+							  cell.name)
+		piece.vx = dx * 4 * piece.speed
+		piece.vy = dy * 4 * piece.speed
+		cell.merge_tick = piece.merge_tick = self.tick + mergeTicks
+		self.player_cells.append(piece)
+		self.dirty.add(cell.cid)
+		self.send_own_id(piece.cid)
+
+	def move(self, cell, target):
+		x0, y0 = cell.x, cell.y
+		dx, dy, d = self.direction(cell, target)
+		step = min(cell.speed, d)
+		cell.x += dx * step + cell.vx
+		cell.y += dy * step + cell.vy
+		cell.vx *= 0.8
+		cell.vy *= 0.8
+		if abs(cell.vx) < 0.5 and abs(cell.vy) < 0.5:
+			cell.vx = cell.vy = 0.0
+		cell.x = min(max(cell.x, 0.0), self.world_size)
+		cell.y = min(max(cell.y, 0.0), self.world_size)
+		if cell.x != x0 or cell.y != y0:
+			self.dirty.add(cell.cid)
+
+	def steer_bot(self, bot):
+		for own in self.player_cells:
+			dx = own.x - bot.x
+			dy = own.y - bot.y
+			if dx * dx + dy * dy < 500.0 ** 2:
+				if bot.size > own.size * 1.1:
+					bot.target = (own.x, own.y)
+				elif own.size > bot.size * 1.1:
+					bot.target = (bot.x - dx, bot.y - dy)
+				return
+		if self.tick % 50 == bot.cid % 50 or \
+				(abs(bot.x - bot.target[0]) < 10 and abs(bot.y - bot.target[1]) < 10):
+			bot.target = self.random_pos()
+
+	def can_eat(self, eater, other):
+		if other.kind == VIRUS and eater.kind != PLAYER:
+			return False
+		if other.kind == PLAYER and eater.kind == PLAYER:
+			# own cells only merge once both timers ran out
+			if self.tick < eater.merge_tick or self.tick < other.merge_tick:
+				return False
+		elif eater.size <= other.size * 1.1:
+			return False
+		dx = eater.x - other.x
+		dy = eater.y - other.y
+		reach = eater.size - other.size / 3.0
+		return reach > 0 and dx * dx + dy * dy < reach * reach
+
+	def eat(self, eater, other):
+		eater.set_mass(eater.mass + other.mass)
+		self.dirty.add(eater.cid)
+		self.eats.append((eater.cid, other.cid))
+		self.remove_cell(other)
+		if other.kind == VIRUS:
+			self.pop_cell(eater)
+
+	def pop_cell(self, cell):
+		"""Virus explosion: split into as many pieces as allowed."""
+		pieces = min(maxPlayerCells - len(self.player_cells) + 1,
+					 int(cell.mass // splitMinMass) + 1)
+		for i in range(1, pieces):
+			angle = 2.0 * math.pi * i / pieces
+			target = (cell.x + math.cos(angle), cell.y + math.sin(angle))
+			self.split_cell(cell, target, cell.mass / (pieces - i + 1))
+
+	def resolve_own_overlaps(self):
+		cells = self.player_cells
+		for i in range(len(cells)):
+			a = cells[i]
+			for b in cells[i + 1:]:
+				if self.tick >= a.merge_tick and self.tick >= b.merge_tick:
+					continue
+				dx = b.x - a.x
+				dy = b.y - a.y
+				d = math.sqrt(dx * dx + dy * dy)
+				overlap = a.size + b.size - d
+				if overlap > 0 and d > 0:
+					push = overlap / 2 / d
+					a.x -= dx * push
+					a.y -= dy * push
+					b.x += dx * push
+					b.y += dy * push
+					self.dirty.add(a.cid)
+					self.dirty.add(b.cid)
+
+	def step(self):
+		self.tick += 1
+		for cell in self.player_cells:
+			self.move(cell, self.target)
+		self.resolve_own_overlaps()
+		for bot in self.bots:
+			self.steer_bot(bot)
+			self.move(bot, bot.target)
+		for em in self.ejected:
+			self.move(em, (em.x, em.y))
+
+		eaters = sorted(self.player_cells + self.bots,
+						key=lambda c: c.size, reverse=True)
+		for eater in eaters:
+			if eater.cid not in self.cells:
+				continue  # eaten earlier in this tick
+			r = eater.size
+			candidates = list(self.food_near(eater.x - r, eater.y - r,
+											 eater.x + r, eater.y + r))
+			candidates.extend(self.ejected)
+			candidates.extend(self.viruses)
+			candidates.extend(self.player_cells)
+			candidates.extend(self.bots)
+			for other in candidates:
+				if other is eater or other.cid not in self.cells:
+					continue
+				if self.can_eat(eater, other):
+					self.eat(eater, other)
+
+		self.send_world_update()
+		if self.tick % self.leaderboard_interval == 0:
+			self.send_leaderboard()
+
+	#==================== server -> client
+
+	def view_box(self):
+		cells = self.player_cells
+		left = min(c.x for c in cells)
+		right = max(c.x for c in cells)
+		top = min(c.y for c in cells)
+		bottom = max(c.y for c in cells)
+		total_size = sum(c.size for c in cells)
+		scale = pow(min(1.0, 64.0 / total_size), 0.4)
+		hw = viewport[0] / 2 / scale
+		hh = viewport[1] / 2 / scale
+		cx = (left + right) / 2
+		cy = (top + bottom) / 2
+		return cx - hw, cy - hh, cx + hw, cy + hh
+
+	def visible_cells(self):
+		x0, y0, x1, y1 = self.view_box()
+		visible = [c for c in self.food_near(x0, y0, x1, y1)
+				   if x0 <= c.x <= x1 and y0 <= c.y <= y1]
+		for group in (self.viruses, self.bots, self.ejected,
+					  self.player_cells):
+			for c in group:
+				if x0 - c.size <= c.x <= x1 + c.size and \
+						y0 - c.size <= c.y <= y1 + c.size:
+					visible.append(c)
+		return visible
+
+	def send_world_update(self):
+		known = self.known
+		eats = [(a, b) for a, b in self.eats
+				if b in known or b in self.own_sent]
+		eaten = set(b for a, b in self.eats)
+		self.own_sent -= eaten
+		del self.eats[:]
+
+		visible = self.visible_cells() if self.player_alive else []
+		visible_ids = set(c.cid for c in visible)
+		parts = [struct.pack('<BH', 16, len(eats))]
+		for a, b in eats:
+			parts.append(struct.pack('<II', a, b))
+		for c in visible:
+			if c.cid in known and c.cid not in self.dirty:
+				continue
+			parts.append(struct.pack('<IiihBBBB', c.cid, int(c.x), int(c.y),
+				int(c.size), c.color[0], c.color[1], c.color[2],
+				1 if c.kind == VIRUS else 0))
+			parts.append(encodeStr16(c.name))
+		parts.append(struct.pack('<I', 0))
+		removed = known - visible_ids - eaten
+		parts.append(struct.pack('<I', len(removed)))
+		for cid in removed:
+			parts.append(struct.pack('<I', cid))
+		self.known = visible_ids
+		self.dirty.clear()
+		self.outbox.append(b''.join(parts))
+
+	def send_own_id(self, cid):
+		self.own_sent.add(cid)
+		self.outbox.append(struct.pack('<BI', 32, cid))
+
+	def send_world_rect(self):
+		self.outbox.append(struct.pack('<Bdddd', 64, 0.0, 0.0,
+									   self.world_size, self.world_size))
+
+	def send_leaderboard(self):
+		players = [(b.mass, b.cid, b.name) for b in self.bots]
+		if self.player_alive:
+			players.append((sum(c.mass for c in self.player_cells),
+							self.player_cells[0].cid, self.nick))
+		players.sort(reverse=True)
+		parts = [struct.pack('<BI', 49, min(10, len(players)))]
+		for mass, cid, name in players[:10]:
+			parts.append(struct.pack('<I', cid))
+			parts.append(encodeStr16(name))
+		self.outbox.append(b''.join(parts))
+
+	#====================
+
+	def step_delay(self):
+		"""
+		Seconds until the next tick is due, or None while there is no
+		player to simulate for.
+		"""
+		if not self.player_alive:
+			return None
+		if self.is_realtime:
+			return self.next_tick - time()
+		if self.lockstep and self.awaiting_command:
+			return self.awaiting_since + self.lockstep_timeout - time()
+		return 0.0
+
+	def poll(self, is_open, block=True):
+		"""
+		Returns the next frame for the client, stepping the game when
+		it is due. Blocks while nothing is due, unless block is false;
+		returns None when nothing is due or once is_open() turns false.
+		"""
+		with self.cond:
+			while 1:
+				if self.outbox:
+					return self.outbox.popleft()
+				if not is_open():
+					return None
+				delay = self.step_delay()
+				if delay is None or delay > 0:
+					if not block:
+						return None
+					self.cond.wait(delay)  # until due, respawn or close
+					continue
+				if self.is_realtime:
+					self.next_tick = max(self.next_tick + 1.0 / self.tick_rate,
+										 time() - 1.0)
+				self.step()
+				self.awaiting_command = True
+				self.awaiting_since = time()
+
+class LocalWebSocket:
+	"""
+	In-process replacement for websocket.WebSocket talking to a
+	LocalServer. recv() blocks on its own, so there is no socket
+	to select() on; poll() is the non-blocking variant.
+	"""
+	def __init__(self, server=None):
+		self.server = server or LocalServer()
+		self.connected = False
+		self.sock = None
+		self.timeout = None
+
+	def settimeout(self, timeout):
+		self.timeout = timeout
+
+	def connect(self, url, **options):
+		self.server.connect()
+		self.connected = True
+
+	def send(self, data):
+		if not self.connected:
+			raise IOError('socket is already closed')
+		self.server.receive(data)
+
+	def recv(self):
+		frame = self.server.poll(lambda: self.connected)
+		if frame is None:
+			raise IOError('socket is already closed')
+		return frame
+
+	def poll(self):
+		"""Returns the next frame if one is ready, else None."""
+		return self.server.poll(lambda: self.connected, block=False)
+
+	def close(self):
+		self.connected = False
+		with self.server.cond:
+			self.server.cond.notify_all()
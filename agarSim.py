@@ -0,0 +1,307 @@
+#! /usr/bin/python2.7
+# -*- coding: utf-8 -*-
+"""
+Vectorized lockstep simulator, to evaluate a whole population at once.
+
+Arenas holds many independent single player arenas as NumPy arrays,
+one agent per arena, with the food, virus and bot rules and tuning of
+agarServer.LocalServer. All arenas step together. inputs() gives the
+network inputs of every agent in the featuresToInputs layout, computed
+from what the server would show the live client (visible cells at
+integer positions), so genomes evolved here drive agarioClient as is.
+
+BatchEvaluator plays one generation of genomes in one set of arenas,
+activating all networks per tick through agarNet.NetworkBatch:
+
+	evaluator = BatchEvaluator(ticks=1500)
+	pop.epoch(evaluator.evalFitness, 200)
+
+Simplifications: an agent is a single cell (split and shoot outputs
+are ignored, a virus is eaten without popping) and bots do not eat
+each other.
+"""
+
+import numpy as np
+
+import agarNet
+from agarIAo import featureCount, emptyFeature, inputCount
+from agarServer import foodSize, virusSize, playerStartMass, \
+	botStartMass, viewport
+
+foodMass = foodSize ** 2 / 100.0
+virusMass = virusSize ** 2 / 100.0
+
+def sizeOf(mass):
+	return np.sqrt(mass * 100.0)
+
+def speedOf(size):
+	return 80.0 * size ** -0.439
+
+def canEat(size, x, y, other_size, other_x, other_y):
+	"""LocalServer.can_eat for arrays, between cells that may eat."""
+	reach = size - other_size / 3.0
+	dx = x - other_x
+	dy = y - other_y
+	return (size > other_size * 1.1) & (reach > 0) & \
+		(dx * dx + dy * dy < reach * reach)
+
+def canEatFood(size, x, y, food_x, food_y):
+	"""
+	canEat against food, which all has foodSize. Computed in float32,
+	in place, as this is the biggest array of a tick.
+	"""
+	reach = np.where(size > foodSize * 1.1, size - foodSize / 3.0, 0.0)
+	dx = np.subtract(x, food_x, dtype=np.float32)
+	dy = np.subtract(y, food_y, dtype=np.float32)
+	np.multiply(dx, dx, out=dx)
+	np.multiply(dy, dy, out=dy)
+	dx += dy
+	return dx < (reach * reach).astype(np.float32)
+
+class Arenas:
+	"""
+	count arenas of world_size with food, viruses and bots each.
+	With shared_start, all arenas start from the same layout, so
+	agents are compared on the same map; respawns differ.
+	"""
+	def __init__(self, count, food=1000, viruses=20, bots=10,
+				 world_size=6000.0, shared_start=True, seed=None):
+		self.count = count
+		self.food_count = food
+		self.virus_count = viruses
+		self.bot_count = bots
+		self.world_size = float(world_size)
+		self.shared_start = shared_start
+		self.random = np.random.RandomState(seed)
+		self.reset()
+
+	def random_pos(self, shape):
+		return (self.random.uniform(0, self.world_size, shape),
+				self.random.uniform(0, self.world_size, shape))
+
+	def start_pos(self, n):
+		if not self.shared_start:
+			return self.random_pos((self.count, n))
+		x, y = self.random_pos((1, n))
+		return np.repeat(x, self.count, 0), np.repeat(y, self.count, 0)
+
+	def reset(self):
+		self.tick = 0
+		n = self.count
+		self.food_x, self.food_y = self.start_pos(self.food_count)
+		self.virus_x, self.virus_y = self.start_pos(self.virus_count)
+		self.bot_x, self.bot_y = self.start_pos(self.bot_count)
+		self.bot_mass = np.full((n, self.bot_count), botStartMass)
+		self.bot_tx = self.bot_x.copy()
+		self.bot_ty = self.bot_y.copy()
+		# bots pick a new random target every 50 ticks, like the
+		# server's tick % 50 == cid % 50
+		self.bot_phase = np.arange(self.bot_count) % 50
+		x, y = self.start_pos(1)
+		self.agent_x = x[:, 0]
+		self.agent_y = y[:, 0]
+		self.agent_mass = np.full(n, playerStartMass)
+		self.alive = np.ones(n, dtype=bool)
+
+	@property
+	def agent_size(self):
+		return sizeOf(self.agent_mass)
+
+	@property
+	def centers(self):
+		"""Agent positions as the client knows them, ints."""
+		return np.trunc(self.agent_x), np.trunc(self.agent_y)
+
+	@property
+	def total_mass(self):
+		"""Agent mass as the client computes it, from int sizes."""
+		return np.trunc(self.agent_size) ** 2 / 100.0
+
+	#====================
+
+	def move(self, x, y, size, tx, ty):
+		dx = tx - x
+		dy = ty - y
+		d = np.sqrt(dx * dx + dy * dy)
+		step = np.minimum(speedOf(size), d) / np.where(d > 0, d, 1.0)
+		return (np.clip(x + dx * step, 0.0, self.world_size),
+				np.clip(y + dy * step, 0.0, self.world_size))
+
+	def steer_bots(self, agent_size, bot_size):
+		dx = self.agent_x[:, None] - self.bot_x
+		dy = self.agent_y[:, None] - self.bot_y
+		near = (dx * dx + dy * dy < 500.0 ** 2) & self.alive[:, None]
+		chase = near & (bot_size > agent_size[:, None] * 1.1)
+		flee = near & (agent_size[:, None] > bot_size * 1.1)
+		reached = (np.abs(self.bot_x - self.bot_tx) < 10) & \
+			(np.abs(self.bot_y - self.bot_ty) < 10)
+		wander = ~near & ((self.tick % 50 == self.bot_phase) | reached)
+		rx, ry = self.random_pos(self.bot_x.shape)
+		self.bot_tx = np.where(chase, self.agent_x[:, None],
+			np.where(flee, self.bot_x - dx, np.where(wander, rx, self.bot_tx)))
+		self.bot_ty = np.where(chase, self.agent_y[:, None],
+			np.where(flee, self.bot_y - dy, np.where(wander, ry, self.bot_ty)))
+
+	def respawn(self, eaten, x, y):
+		if eaten.any():
+			rx, ry = self.random_pos(eaten.sum())
+			x[eaten] = rx
+			y[eaten] = ry
+
+	def step(self, target_x, target_y):
+		"""Moves every live agent towards its target, one server tick."""
+		self.tick += 1
+		alive = self.alive
+		size = self.agent_size
+		x, y = self.move(self.agent_x, self.agent_y, size, target_x, target_y)
+		self.agent_x = np.where(alive, x, self.agent_x)
+		self.agent_y = np.where(alive, y, self.agent_y)
+		bot_size = sizeOf(self.bot_mass)
+		self.steer_bots(size, bot_size)
+		self.bot_x, self.bot_y = self.move(self.bot_x, self.bot_y, bot_size,
+										   self.bot_tx, self.bot_ty)
+
+		ax = self.agent_x[:, None]
+		ay = self.agent_y[:, None]
+		live = alive[:, None]
+		food = canEatFood(size[:, None], ax, ay,
+						  self.food_x, self.food_y) & live
+		viruses = canEat(size[:, None], ax, ay, virusSize,
+						 self.virus_x, self.virus_y) & live
+		bots = canEat(size[:, None], ax, ay, bot_size,
+					  self.bot_x, self.bot_y) & live
+		eaten = (canEat(bot_size, self.bot_x, self.bot_y, size[:, None], ax, ay)
+				 & ~bots).any(1) & alive
+		gained = food.sum(1) * foodMass + viruses.sum(1) * virusMass + \
+			(self.bot_mass * bots).sum(1)
+
+		# bots eat what the agent left, each food goes to one bot
+		by_bots = canEatFood(bot_size[:, :, None], self.bot_x[:, :, None],
+							 self.bot_y[:, :, None], self.food_x[:, None, :],
+							 self.food_y[:, None, :]) & ~food[:, None, :]
+		eaters = by_bots.sum(1)
+		bot_food = eaters > 0
+		meals = by_bots.sum(2)
+		a, f = np.nonzero(eaters > 1)
+		if len(a):  # rare: only the first bot gets it
+			others = by_bots[a, :, f]
+			others[np.arange(len(a)), others.argmax(1)] = False
+			np.add.at(meals, a, -others.astype(meals.dtype))
+		self.bot_mass += foodMass * meals
+
+		self.respawn(food | bot_food, self.food_x, self.food_y)
+		self.respawn(viruses, self.virus_x, self.virus_y)
+		self.respawn(bots, self.bot_x, self.bot_y)
+		self.bot_mass[bots] = botStartMass
+		self.bot_tx[bots] = self.bot_x[bots]
+		self.bot_ty[bots] = self.bot_y[bots]
+		self.agent_mass = self.agent_mass + gained
+		self.alive = alive & ~eaten
+
+	#====================
+
+	def visible(self, x, y, size, cx, cy, hw, hh, margin):
+		# what LocalServer.visible_cells sends, food strictly in view
+		m = size if margin else 0.0
+		return (np.abs(x - cx[:, None]) <= hw[:, None] + m) & \
+			(np.abs(y - cy[:, None]) <= hh[:, None] + m)
+
+	def nearest(self, out, column, x, y, size, visible, cx, cy, skip_center):
+		"""Writes the featureCount nearest cells of one category."""
+		if not x.shape[1]:
+			out[:, column:column + 4 * featureCount] = emptyFeature * featureCount
+			return
+		x = np.trunc(x)
+		y = np.trunc(y)
+		size = np.trunc(np.broadcast_to(size, x.shape))
+		dx = x - cx[:, None]
+		dy = y - cy[:, None]
+		distance = np.sqrt(dx * dx + dy * dy)
+		visible = visible & (distance != 0) if skip_center else visible
+		distance = np.where(visible, distance, np.inf)
+		k = min(featureCount, distance.shape[1])
+		rows = np.arange(self.count)[:, None]
+		if distance.shape[1] > k:
+			idx = np.argpartition(distance, k - 1, axis=1)[:, :k]
+		else:
+			idx = np.broadcast_to(np.arange(k), (self.count, k))
+		keys = [a[rows, idx] for a in (size, dy, dx, distance)]
+		order = np.lexsort(keys, axis=1)
+		size, dy, dx, distance = [key[rows, order] for key in keys]
+		features = np.empty((self.count, featureCount, 4))
+		features[:] = emptyFeature
+		features[:, :k] = np.stack([distance, dx, dy, size], axis=2)
+		features[:, :k][np.isinf(distance)] = emptyFeature  # not in view
+		out[:, column:column + 4 * featureCount] = \
+			features.reshape(self.count, 4 * featureCount)
+
+	def inputs(self, out=None):
+		"""
+		Network inputs of all agents, shape (count, inputCount), in the
+		layout featuresToInputs gives computeFeatures' result.
+		"""
+		if out is None:
+			out = np.empty((self.count, inputCount))
+		size = self.agent_size
+		cx, cy = self.centers
+		scale = np.minimum(1.0, 64.0 / size) ** 0.4
+		hw = viewport[0] / 2 / scale
+		hh = viewport[1] / 2 / scale
+		sx = self.agent_x
+		sy = self.agent_y
+		groups = [
+			(self.food_x, self.food_y, foodSize, False, False),  # food
+			(self.bot_x, self.bot_y, sizeOf(self.bot_mass), True, True),  # enemy
+			(self.virus_x, self.virus_y, virusSize, True, False),  # virus
+		]
+		column = 0
+		for x, y, cell_size, margin, skip_center in groups:
+			visible = self.visible(x, y, cell_size, sx, sy, hw, hh, margin)
+			self.nearest(out, column, x, y, cell_size, visible, cx, cy,
+						 skip_center)
+			column += 4 * featureCount
+		out[:, column:column + 4 * featureCount] = emptyFeature * featureCount  # no ejected mass
+		out[:, -1] = self.total_mass
+		return out
+
+class BatchEvaluator:
+	"""
+	evalFitness for population.epoch: plays all genomes of a
+	generation at once, each in its own arena, for at most ticks
+	ticks. Fitness follows SubscriberMock.run: the mass gained from
+	the second decision until the last one alive, at least 0.
+	Extra keyword arguments are passed to Arenas.
+	"""
+	def __init__(self, ticks=1500, seed=None, **kwargs):
+		self.ticks = ticks
+		self.random = np.random.RandomState(seed)
+		self.kwargs = kwargs
+
+	def evalFitness(self, genomes, ticks=0):
+		"""ticks, if set, replaces the episode length."""
+		print("evalFitness (%d arenas)" % len(genomes))
+		nets = agarNet.NetworkBatch([agarNet.compilePhenotype(g) for g in genomes])
+		arenas = Arenas(len(genomes), seed=self.random.randint(2 ** 31),
+						**self.kwargs)
+		inputs = np.empty((len(genomes), inputCount))
+		start_mass = np.zeros(len(genomes))
+		last_mass = np.zeros(len(genomes))
+		for tick in range(ticks or self.ticks):
+			alive = arenas.alive
+			if not alive.any():
+				break
+			arenas.inputs(inputs)
+			mass = inputs[:, -1]
+			if tick == 1:
+				start_mass[:] = mass
+			last_mass = np.where(alive, mass, last_mass)
+			output = nets.sactivate(inputs)
+			cx, cy = arenas.centers
+			# what sendTarget sends: ints
+			arenas.step(np.trunc(cx + 50 * (output[:, 0] - 0.5)),
+						np.trunc(cy + 50 * (output[:, 1] - 0.5)))
+		fitness = np.maximum(0.0, last_mass - start_mass)
+		for g, f in zip(genomes, fitness.tolist()):
+			g.fitness = f
+		print("best %s, mean %s, %d alive after %d ticks" % (
+			fitness.max(), fitness.mean(), arenas.alive.sum(), arenas.tick))
@@ -0,0 +1,208 @@
+#! /usr/bin/python2.7
+# -*- coding: utf-8 -*-
+"""
+Lightweight in-process instrumentation.
+
+registry collects latency histograms and counters while
+registry.enabled is set; when it is not, every recording call
+returns right away. agarIAo records:
+
+	parse.<packet>      parse time per packet type
+	packets.in/out      packets and bytes.in/out, also per second
+	lock.cellsMutex     time spent waiting for World.cellsMutex
+	tick.<step>         SubscriberMock.run steps: features, activate,
+	                    render, send and the whole tick
+	episode.<reason>    episodes ended early, see agarRacing
+	fitness.*           evaluated and cached genomes, see agarFitness
+	pool.*              session pool connections, failures, drops and
+	                    checkout waits, see agarPool
+	outbox.*            commands sent, coalesced, deduplicated and
+	                    deferred, see agarOutbox
+
+The report can be written to a JSON file (dump) or served as JSON
+from a local HTTP endpoint (serve):
+
+	registry.enabled = True
+	registry.serve(8000)  # curl localhost:8000
+"""
+
+import json
+import threading
+from time import time
+
+class Histogram:
+	"""Durations in power of two microsecond buckets."""
+	def __init__(self):
+		self.buckets = {}  # k -> count of durations < 2**k us
+		self.count = 0
+		self.total = 0.0
+		self.min = None
+		self.max = 0.0
+
+	def observe(self, seconds):
+		k = int(seconds * 1e6).bit_length()
+		self.buckets[k] = self.buckets.get(k, 0) + 1
+		self.count += 1
+		self.total += seconds
+		if self.min is None or seconds < self.min:
+			self.min = seconds
+		if seconds > self.max:
+			self.max = seconds
+
+	def quantile(self, q):
+		"""Upper bound in us of the bucket holding quantile q."""
+		rank = q * self.count
+		seen = 0
+		for k in sorted(self.buckets):
+			seen += self.buckets[k]
+			if seen >= rank:
+				return float(2 ** k)
+		return 0.0
+
+	def report(self):
+		if not self.count:
+			return {'count': 0}
+		return {
+			'count': self.count,
+			'mean_us': 1e6 * self.total / self.count,
+			'min_us': 1e6 * self.min,
+			'max_us': 1e6 * self.max,
+			'p50_us': self.quantile(0.5),
+			'p90_us': self.quantile(0.9),
+			'p99_us': self.quantile(0.99),
+			'buckets_us': dict(('<%i' % 2 ** k, n)
+							   for k, n in self.buckets.items()),
+		}
+
+class Laps:
+	"""
+	Times consecutive steps: start(), then lap(name) after each step
+	records the time since the previous call as prefix.name.
+	"""
+	def __init__(self, registry, prefix):
+		self.registry = registry
+		self.prefix = prefix
+		self.first = self.last = 0.0
+
+	def start(self):
+		if self.registry.enabled:
+			self.first = self.last = time()
+
+	def lap(self, name):
+		if self.registry.enabled:
+			now = time()
+			self.registry.observe(self.prefix + name, now - self.last)
+			self.last = now
+
+	def stop(self, name='total'):
+		"""Records the time since start() as prefix.name."""
+		if self.registry.enabled:
+			self.registry.observe(self.prefix + name, time() - self.first)
+
+class TimedLock:
+	"""Lock wrapper recording the time acquire() waits as lock.name."""
+	def __init__(self, lock, name, registry):
+		self.lock = lock
+		self.name = 'lock.' + name
+		self.registry = registry
+
+	def acquire(self, blocking=True):
+		if not self.registry.enabled:
+			return self.lock.acquire(blocking)
+		start = time()
+		got = self.lock.acquire(blocking)
+		self.registry.observe(self.name, time() - start)
+		return got
+
+	def release(self):
+		self.lock.release()
+
+	def __enter__(self):
+		self.acquire()
+		return self
+
+	def __exit__(self, *exc):
+		self.release()
+
+class Registry:
+	def __init__(self):
+		self.enabled = False
+		self.lock = threading.Lock()
+		self.server = None
+		self.reset()
+
+	def reset(self):
+		with self.lock:
+			self.histograms = {}
+			self.counters = {}
+			self.since = time()
+
+	def observe(self, name, seconds):
+		if not self.enabled:
+			return
+		with self.lock:
+			histogram = self.histograms.get(name)
+			if histogram is None:
+				histogram = self.histograms[name] = Histogram()
+			histogram.observe(seconds)
+
+	def count(self, name, n=1):
+		if not self.enabled:
+			return
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + n
+
+	def laps(self, prefix):
+		return Laps(self, prefix + '.')
+
+	def report(self):
+		"""Everything recorded since the last reset, as a dict."""
+		with self.lock:
+			elapsed = max(time() - self.since, 1e-9)
+			return {
+				'elapsed_s': elapsed,
+				'counters': dict(self.counters),
+				'per_second': dict((name, n / elapsed)
+								   for name, n in self.counters.items()),
+				'histograms': dict((name, h.report())
+								   for name, h in self.histograms.items()),
+			}
+
+	def dump(self, path):
+		with open(path, 'w') as f:
+			json.dump(self.report(), f, indent=1, sort_keys=True)
+
+	def serve(self, port, host='127.0.0.1'):
+		"""Serves report() as JSON on a daemon thread."""
+		try:
+			from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+		except ImportError:
+			from http.server import HTTPServer, BaseHTTPRequestHandler
+		registry = self
+
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				body = json.dumps(registry.report(), indent=1,
+								  sort_keys=True).encode('utf-8')
+				self.send_response(200)
+				self.send_header('Content-Type', 'application/json')
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				pass
+
+		self.server = HTTPServer((host, port), Handler)
+		t = threading.Thread(target=self.server.serve_forever)
+		t.daemon = True
+		t.start()
+		return self.server
+
+	def stop(self):
+		if self.server is not None:
+			self.server.shutdown()
+			self.server.server_close()
+			self.server = None
+
+registry = Registry()
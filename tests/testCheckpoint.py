@@ -0,0 +1,101 @@
+#! /usr/bin/python2.7
+# -*- coding: utf-8 -*-
+"""
+Resuming agarIAo.evolve from agarCheckpoint checkpoints.
+
+	python -m unittest discover tests
+"""
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from neat import population
+from neat.config import Config
+
+import agarCheckpoint
+from agarCheckpoint import Checkpointer
+from agarIAo import evolve
+
+class Interrupted(Exception):
+	pass
+
+class Recorder:
+	"""evalFitness recording what it evaluates, failing on call fail_at."""
+	def __init__(self, fail_at=None):
+		self.fail_at = fail_at
+		self.calls = 0
+		self.ids = []
+
+	def evalFitness(self, genomes):
+		if self.calls == self.fail_at:
+			raise Interrupted()
+		self.calls += 1
+		for g in genomes:
+			g.fitness = len(g.conn_genes) + random.random()
+		self.ids.extend(g.ID for g in genomes)
+
+class EvolveTest(unittest.TestCase):
+	def setUp(self):
+		self.config = Config(os.path.join(
+			os.path.dirname(os.path.abspath(__file__)), os.pardir, 'agarIAo_config'))
+		self.config.pop_size = 20
+		# elites keep their id and are evaluated again every generation
+		self.config.elitism = 0
+		self.path = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.path)
+
+	def newProcess(self, seed):
+		"""Like starting over: fresh neat counters and random state."""
+		pop = population.Population(self.config)
+		for (cls, name), value in zip(agarCheckpoint.idCounters(pop),
+									  [1, 1, 0, {}]):
+			setattr(cls, name, value)
+		random.seed(seed)
+		return population.Population(self.config)
+
+	def play(self, generations, recorder, path=None, seed=0):
+		pop = self.newProcess(seed)
+		evolve(pop, recorder.evalFitness, generations,
+			   Checkpointer(path or self.path))
+		return pop
+
+	def straight(self, generations):
+		recorder = Recorder()
+		self.play(generations, recorder, os.path.join(self.path, 'straight'))
+		return recorder
+
+	def test_extend(self):
+		first = Recorder()
+		self.play(3, first)
+		second = Recorder()
+		pop = self.play(6, second, seed=1)
+		self.assertEqual(second.calls, 3)
+		self.assertEqual(pop.generation, 5)
+		ids = first.ids + second.ids
+		self.assertEqual(len(ids), len(set(ids)))
+		self.assertEqual(ids, self.straight(6).ids)
+
+	def test_interrupted(self):
+		first = Recorder(fail_at=2)
+		self.assertRaises(Interrupted, self.play, 5, first)
+		second = Recorder()
+		pop = self.play(5, second, seed=1)
+		self.assertEqual(second.calls, 3)
+		self.assertEqual(pop.generation, 4)
+		ids = first.ids + second.ids
+		self.assertEqual(len(ids), len(set(ids)))
+		self.assertEqual(ids, self.straight(5).ids)
+
+	def test_done(self):
+		self.play(2, Recorder())
+		recorder = Recorder()
+		self.play(2, recorder)
+		self.assertEqual(recorder.calls, 0)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,99 @@
+#! /usr/bin/python2.7
+# -*- coding: utf-8 -*-
+"""
+agarNet.CompiledNetwork and NetworkBatch against nn_pure, on genomes
+evolved to have hidden nodes, recurrent connections and tanh nodes.
+
+	python -m unittest discover tests
+"""
+
+import os
+import random
+import unittest
+from collections import OrderedDict
+
+import numpy as np
+from neat import population
+from neat.config import Config
+from neat.nn import nn_pure as nn
+
+import agarNet
+
+def mutatedGenomes(generations=10, seed=0):
+	"""The last generation of a run rewarding bigger networks."""
+	random.seed(seed)
+	config = Config(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+								 os.pardir, 'agarIAo_config'))
+	config.pop_size = 30
+	config.prob_addnode = 0.3
+	config.prob_addconn = 0.5
+	last = []
+	def evaluate(genomes):
+		for g in genomes:
+			g.fitness = len(g.node_genes) + len(g.conn_genes) + random.random()
+		last[:] = genomes
+	pop = population.Population(config)
+	pop.epoch(evaluate, generations, report=False, checkpoint_interval=None)
+	rnd = random.Random(seed)
+	for g in last:
+		# nn_pure needs the inputs first, node_genes is a plain dict
+		genes = sorted(g.node_genes.items(), key=lambda kv: kv[1].type != 'INPUT')
+		g.node_genes = OrderedDict(genes)
+	for g in last[::2]:
+		for ng in g.node_genes.values():
+			if ng.type != 'INPUT' and rnd.random() < 0.5:
+				ng.activation_type = 'tanh'
+	return last
+
+def recurrentSynapses(net):
+	"""Synapses read before their source is updated in the same step."""
+	position = dict((n.ID, i) for i, n in enumerate(net.neurons))
+	return [s for n in net.neurons for s in n._synapses
+			if position[s.source.ID] >= position[n.ID]]
+
+class CompiledNetworkTest(unittest.TestCase):
+	steps = 10
+
+	@classmethod
+	def setUpClass(cls):
+		cls.genomes = mutatedGenomes()
+
+	def inputs(self, rnd):
+		return [rnd.uniform(-3.0, 3.0) for i in range(self.genomes[0].num_inputs)]
+
+	def test_genomes(self):
+		# make sure the paths compiling is about are exercised
+		nets = [nn.create_phenotype(g) for g in self.genomes]
+		self.assertTrue(any(n.type == 'HIDDEN' for net in nets for n in net.neurons))
+		self.assertTrue(any(n.activation is nn.tanh_sigmoid
+							for net in nets for n in net.neurons))
+		self.assertTrue(any(recurrentSynapses(net) for net in nets))
+		self.assertTrue(any(len(agarNet.compilePhenotype(g).layers) > 1
+							for g in self.genomes))
+
+	def test_sactivate(self):
+		rnd = random.Random(1)
+		for g in self.genomes:
+			pure = nn.create_phenotype(g)
+			compiled = agarNet.compilePhenotype(g)
+			for step in range(self.steps):
+				x = self.inputs(rnd)
+				expected = pure.sactivate(x)
+				got = compiled.sactivate(x)
+				self.assertEqual(len(got), len(expected))
+				for a, b in zip(expected, got):
+					self.assertAlmostEqual(a, b, places=12)
+
+	def test_batch(self):
+		rnd = random.Random(2)
+		nets = [agarNet.compilePhenotype(g) for g in self.genomes]
+		batch = agarNet.NetworkBatch(nets)
+		pures = [nn.create_phenotype(g) for g in self.genomes]
+		for step in range(self.steps):
+			x = np.array([self.inputs(rnd) for net in nets])
+			got = batch.sactivate(x)
+			expected = [pure.sactivate(list(row)) for pure, row in zip(pures, x)]
+			np.testing.assert_allclose(got, expected, rtol=0, atol=1e-12)
+
+if __name__ == '__main__':
+	unittest.main()
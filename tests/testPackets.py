@@ -0,0 +1,130 @@
+#! /usr/bin/python2.7
+# -*- coding: utf-8 -*-
+"""
+BufferStruct.pop_cell_records against the field by field parser it
+replaced (parse_world_update and BufferStruct.pop_str8/pop_str16 of
+the baseline client).
+
+	python -m unittest discover tests
+"""
+
+import random
+import struct
+import unittest
+
+from agarIAo import BufferStruct, BufferUnderflowError
+
+def legacyStr16(buf):
+	chars = []
+	while 1:
+		c = buf.pop_uint16()
+		if (c == 0) or (c > 254) or (c == 14):
+			break
+		chars.append(chr(c))
+	return ''.join(chars)
+
+def legacyStr8(buf):
+	chars = []
+	while 1:
+		c = buf.pop_uint8()
+		if c == 0:
+			break
+		chars.append(chr(c))
+	return ''.join(chars)
+
+def legacyCellRecords(buf):
+	records = []
+	while 1:
+		cid = buf.pop_uint32()
+		if cid == 0:
+			break
+		cx = buf.pop_int32()
+		cy = buf.pop_int32()
+		csize = buf.pop_int16()
+		color = (buf.pop_uint8(), buf.pop_uint8(), buf.pop_uint8())
+		bitmask = buf.pop_uint8()
+		if bitmask & 2:  # skip padding
+			for i in range(buf.pop_uint32()):
+				buf.pop_uint8()
+		if bitmask & 4:  # skin URL
+			skin_url = legacyStr8(buf)
+			# the baseline tested skin_url[0], which fails on ''
+			if not skin_url.startswith(':'):
+				skin_url = ''
+		else:
+			skin_url = ''
+		cname = legacyStr16(buf)
+		records.append((cid, cx, cy, csize, color,
+						bool(bitmask & 1), bool(bitmask & 16), skin_url, cname))
+	return records
+
+def encodeName(units):
+	return struct.pack('<%iH' % len(units), *units) + b'\0\0'
+
+def randomRecord(rnd):
+	cid = rnd.randint(1, 2 ** 32 - 1)
+	bitmask = rnd.choice([0, 1, 16, 17]) | rnd.choice([0, 2]) | rnd.choice([0, 4])
+	parts = [struct.pack('<IiihBBBB', cid,
+						 rnd.randint(-2 ** 31, 2 ** 31 - 1),
+						 rnd.randint(-2 ** 31, 2 ** 31 - 1),
+						 rnd.randint(-2 ** 15, 2 ** 15 - 1),
+						 rnd.randint(0, 255), rnd.randint(0, 255),
+						 rnd.randint(0, 255), bitmask)]
+	if bitmask & 2:
+		padding = rnd.randint(0, 8)
+		parts.append(struct.pack('<I', padding) + b'\xab' * padding)
+	if bitmask & 4:
+		skin = rnd.choice(['', ':', ':doge', 'doge', ':http://x/y.png'])
+		parts.append(skin.encode('latin-1') + b'\0')
+	units = [rnd.choice([rnd.randint(1, 13), rnd.randint(15, 254)])
+			 for i in range(rnd.randint(0, 12))]
+	parts.append(encodeName(units))
+	return b''.join(parts)
+
+def randomSection(rnd, n):
+	return b''.join(randomRecord(rnd) for i in range(n)) + struct.pack('<I', 0)
+
+class CellRecordsTest(unittest.TestCase):
+	def decode(self, packet):
+		new = BufferStruct(packet)
+		old = BufferStruct(packet)
+		records = new.pop_cell_records()
+		self.assertEqual(records, legacyCellRecords(old))
+		self.assertEqual(new.offset, old.offset)
+		return records
+
+	def test_empty(self):
+		self.assertEqual(self.decode(struct.pack('<I', 0)), [])
+
+	def test_names(self):
+		packet = (struct.pack('<IiihBBBB', 7, -5, 9, 32, 1, 2, 3, 4 | 16)
+				  + b':skin\0' + encodeName([ord(c) for c in u'zoë'])
+				  # 14 and units above 254 end a name too
+				  + struct.pack('<IiihBBBB', 8, 0, 0, 10, 0, 0, 0, 1)
+				  + struct.pack('<HH', ord('a'), 0x263a)
+				  + struct.pack('<IiihBBBB', 9, 0, 0, 10, 0, 0, 0, 0)
+				  + struct.pack('<HH', ord('b'), 14)
+				  + struct.pack('<I', 0))
+		records = self.decode(packet + b'\x05\x00')
+		self.assertEqual([r[-1] for r in records], ['zo\xeb', 'a', 'b'])
+		self.assertEqual(records[0][-2], ':skin')
+
+	def test_random(self):
+		rnd = random.Random(0)
+		for i in range(300):
+			# trailing bytes stand in for the removed cells section
+			self.decode(randomSection(rnd, rnd.randint(0, 20)) + b'\x00' * 4)
+
+	def test_truncated(self):
+		rnd = random.Random(1)
+		for i in range(100):
+			packet = randomSection(rnd, rnd.randint(1, 5))
+			for end in range(len(packet)):
+				truncated = packet[:end]
+				self.assertRaises(BufferUnderflowError,
+								  legacyCellRecords, BufferStruct(truncated))
+				self.assertRaises(BufferUnderflowError,
+								  BufferStruct(truncated).pop_cell_records)
+
+if __name__ == '__main__':
+	unittest.main()